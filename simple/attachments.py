@@ -0,0 +1,68 @@
+"""
+@Desc : file attached to the chat with --file, mapped once and encoded once per file version
+"""
+import base64
+import logging
+import mmap
+import os
+from pathlib import Path
+from typing import Union
+
+
+class Attachment:
+    """memory-mapped attachment, the raw bytes and base64 encoding are cached by (path, mtime, size)"""
+    def __init__(self, path: Union[str, Path]):
+        self.path: Path = Path(path).resolve()
+        self._key: tuple[str, int, int] | None = None
+        self._file = None
+        self._map: mmap.mmap | None = None
+        self._raw: bytes | None = None
+        self._base64: str | None = None
+
+    @property
+    def name(self) -> str:
+        return self.path.name
+
+    @property
+    def suffix(self) -> str:
+        return self.path.suffix
+
+    def _refresh(self) -> None:
+        """remap the file when it changed since the last access"""
+        stat = os.stat(self.path)
+        key = (str(self.path), stat.st_mtime_ns, stat.st_size)
+        if key == self._key:
+            return
+        if self._key is not None:
+            logging.info(f"Attachment {self.path} changed, reloading")
+        self.close()
+        self._file = open(self.path, "rb")
+        # an empty file cannot be mapped
+        if stat.st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._key = key
+
+    @property
+    def raw(self) -> bytes:
+        self._refresh()
+        if self._raw is None:
+            self._raw = self._map[:] if self._map is not None else b""
+        return self._raw
+
+    @property
+    def base64(self) -> str:
+        self._refresh()
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self._map if self._map is not None else b"").decode("ascii")
+        return self._base64
+
+    def close(self) -> None:
+        self._raw = None
+        self._base64 = None
+        self._key = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,108 @@
+"""
+@Desc : accuracy and speed of tool call extraction over a corpus of model outputs
+
+compares extract_tool_call with the previous rule (the whole response must be json), then
+times the extractor on growing responses to check that it stays linear. the report is json.
+
+    cd simple && python -m bench.extract_bench --output extract.json
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+from client import READ_RESULT_TOOL, extract_tool_call
+
+BENCH_DIR = Path(__file__).resolve().parent
+# tools of the servers in servers_config.json
+TOOL_NAMES = {"read_file", "write_file", "detective_chat", "suspect_chat", READ_RESULT_TOOL}
+
+
+def whole_json(text: str, tool_names) -> Any:
+    """the rule before extract_tool_call"""
+    try:
+        value = json.loads(text)
+    except ValueError:
+        return None
+    if isinstance(value, dict) and value.get("tool"):
+        return value
+    if isinstance(value, list) and value and all(isinstance(call, dict) and call.get("tool") for call in value):
+        return value
+    return None
+
+
+def per_call_us(extract: Callable, text: str, min_time: float = 0.05) -> float:
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        extract(text, TOOL_NAMES)
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / runs * 1e6
+
+
+def evaluate(corpus: list[dict[str, Any]], extract: Callable) -> dict[str, Any]:
+    missed, false_calls = [], []
+    for index, case in enumerate(corpus):
+        found = extract(case["output"], TOOL_NAMES)
+        if found != case["expected"]:
+            (missed if case["expected"] is not None else false_calls).append(index)
+    calls = sum(case["expected"] is not None for case in corpus)
+    return {
+        "accuracy": 1 - (len(missed) + len(false_calls)) / len(corpus),
+        "tool_calls_found": calls - len(missed),
+        "tool_calls": calls,
+        "missed": missed,
+        "false_calls": false_calls,
+        "mean_us": sum(per_call_us(extract, case["output"]) for case in corpus) / len(corpus),
+    }
+
+
+def scaling(sizes: list[int]) -> list[dict[str, Any]]:
+    """prose with stray brackets before a fenced tool call, the cost per byte should stay flat
+
+    the unclosed filler opens brackets that never close, each of them is a value start that
+    runs to the end of the text.
+    """
+    call = json.dumps({"tool": "read_file", "arguments": {"file_path": "example.txt"}}, ensure_ascii=False)
+    fillers = {"balanced": "分析 [步骤] 与 {说明} 的内容, ", "unclosed": '{ [ "tool" '}
+    results = []
+    for name, filler in fillers.items():
+        for size in sizes:
+            text = (filler * (size // len(filler) + 1))[:size] + f"\n```json\n{call}\n```"
+            assert extract_tool_call(text, TOOL_NAMES) is not None
+            elapsed = per_call_us(extract_tool_call, text, min_time=0.2)
+            results.append({"filler": name, "chars": len(text), "us": elapsed, "ns_per_char": elapsed * 1e3 / len(text)})
+    return results
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", type=str, default=str(BENCH_DIR / "tool_call_corpus.jsonl"))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--output", type=str, help="write the json report here instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    with open(args.corpus, "r", encoding="utf-8") as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+    report = {
+        "corpus": args.corpus,
+        "cases": len(corpus),
+        "whole_json": evaluate(corpus, whole_json),
+        "extract_tool_call": evaluate(corpus, extract_tool_call),
+        "scaling": scaling(args.sizes),
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
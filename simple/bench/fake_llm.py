@@ -0,0 +1,111 @@
+"""
+@Desc : offline openai compatible chat completions server answering from a script
+
+the answer only depends on the request, so any number of concurrent conversations can
+share one server: the n-th llm request of a turn (n = tool result messages since the last
+user message) gets script[n], the last entry is repeated once the script runs out.
+
+    python -m bench.fake_llm --port 8901 --latency 0.05 --token-latency 0.002
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from client import ChatSession
+
+# two parallel tool calls, one tool call, then the final answer
+DEFAULT_SCRIPT = [
+    json.dumps([
+        {"tool": "stdio_echo", "arguments": {"text": "你好"}},
+        {"tool": "sse_lookup", "arguments": {"key": "bench", "size": 2048}},
+    ]),
+    json.dumps({"tool": "sse_echo", "arguments": {"text": "world"}}),
+    "根据工具的执行结果, 这是最终的回答。",
+]
+
+
+def script_step(messages: list[dict]) -> int:
+    """number of tool rounds already fed back in the current turn"""
+    step = 0
+    for message in reversed(messages):
+        if message.get("role") != "user":
+            continue
+        if not str(message.get("content", "")).startswith(ChatSession.TOOL_RESULT_PREFIX):
+            break
+        step += 1
+    return step
+
+
+def create_app(script: list[str], latency: float = 0.05, token_latency: float = 0.0, chunk_size: int = 4) -> Starlette:
+    """
+    Args:
+        latency: seconds before the first byte of every response
+        token_latency: seconds between streamed chunks of chunk_size characters
+    """
+    async def chat_completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        text = script[min(script_step(messages), len(script) - 1)]
+        prompt_chars = sum(len(str(message.get("content", ""))) for message in messages)
+        usage = {
+            "prompt_tokens": prompt_chars // 4,
+            "completion_tokens": len(text) // 4,
+            "total_tokens": (prompt_chars + len(text)) // 4,
+        }
+        created = int(time.time())
+        model = body.get("model", "fake")
+        await asyncio.sleep(latency)
+        if not body.get("stream"):
+            return JSONResponse({
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        async def chunks():
+            for start in range(0, len(text), chunk_size):
+                chunk = {
+                    "id": "chatcmpl-bench",
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": text[start:start + chunk_size]}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                if token_latency:
+                    await asyncio.sleep(token_latency)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+    return Starlette(routes=[Route("/v1/chat/completions", chat_completions, methods=["POST"])])
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="listen address")
+    parser.add_argument("--port", type=int, default=8901, help="listen port")
+    parser.add_argument("--script", type=str, help="json file with the list of scripted responses")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before the first byte")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds between streamed chunks")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script, "r", encoding="utf-8") as f:
+            script = json.load(f)
+    app = create_app(script, latency=args.latency, token_latency=args.token_latency)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,44 @@
+"""
+@Desc : local mcp server for benchmarks, the same tools over stdio or sse with a fixed latency
+
+    python bench/mcp_standin.py --prefix stdio_ --latency 0.01
+    python bench/mcp_standin.py --prefix sse_ --transport sse --port 8902
+"""
+import argparse
+import asyncio
+
+from mcp.server.fastmcp import FastMCP
+
+
+def create_server(prefix: str = "", latency: float = 0.0, **settings) -> FastMCP:
+    mcp = FastMCP("bench", log_level="WARNING", **settings)
+
+    async def echo(text: str) -> str:
+        """返回输入的文本"""
+        await asyncio.sleep(latency)
+        return text
+
+    async def lookup(key: str, size: int = 1024) -> str:
+        """返回指定大小的文本数据"""
+        await asyncio.sleep(latency)
+        return (key + " ") * (max(size, 0) // (len(key) + 1))
+
+    mcp.add_tool(echo, name=f"{prefix}echo")
+    mcp.add_tool(lookup, name=f"{prefix}lookup")
+    return mcp
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prefix", type=str, default="", help="prefix of the tool names")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every tool call takes")
+    parser.add_argument("--transport", choices=["stdio", "sse"], default="stdio")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="sse listen address")
+    parser.add_argument("--port", type=int, default=8902, help="sse listen port")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    settings = {"host": args.host, "port": args.port} if args.transport == "sse" else {}
+    create_server(args.prefix, args.latency, **settings).run(transport=args.transport)
@@ -0,0 +1,192 @@
+"""
+@Desc : randomized checks of patch_file and of read_file cursors
+
+applies random difflib diffs (with "\\ No newline at end of file" markers, LF and CRLF
+files, form feeds and unicode line separators inside lines, 0 to 3 context lines) through
+patch_file and compares the result with the target text, then pages through a multibyte file
+by byte ranges and line ranges with cursors and compares the reassembled content with the
+file. the report is json, the exit status is 1 when a check fails.
+
+    cd simple && python -m bench.patch_check --cases 400 --output patch.json
+"""
+import argparse
+import difflib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any
+
+# str.splitlines splits on the control and separator characters, reading a file does not
+WORDS = ["alpha", "beta", "gamma", "日志", "数据 ✓", "emoji 😀", "", "page\x0cfeed", "v\x0btab", "fs\x1cgs\x1drs\x1e", "nel\x85", "ls\u2028ps\u2029"]
+
+
+def read_exact(path: Path) -> str:
+    """file content with its line endings as they are"""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        return f.read()
+
+
+def file_lines(text: str) -> list[str]:
+    """lines with their line endings, split like reading the file"""
+    return [line for line in re.split(r"(?<=\n)", text) if line]
+
+
+def unified_diff(old: str, new: str, context: int) -> str:
+    # difflib leaves the marker out, add it after a last line without line ending like diff(1)
+    return "".join(
+        line if line.endswith("\n") else line + "\n\\ No newline at end of file\n"
+        for line in difflib.unified_diff(file_lines(old), file_lines(new), "a/p.txt", "b/p.txt", n=context)
+    )
+
+
+def random_pair(rng: random.Random, eol: str) -> tuple[str, str]:
+    old = [rng.choice(WORDS) for _ in range(rng.randint(0, 12))]
+    new = list(old)
+    for _ in range(rng.randint(1, 4)):
+        k = rng.randint(0, len(new))
+        op = rng.random()
+        if op < 0.4:
+            new.insert(k, rng.choice(WORDS) + "+")
+        elif op < 0.7 and new:
+            del new[min(k, len(new) - 1)]
+        elif new:
+            new[min(k, len(new) - 1)] = "changed"
+
+    def join(lines: list[str]) -> str:
+        # about a third of the files end without a line ending
+        return eol.join(lines) + (eol if lines and rng.random() < 0.7 else "")
+
+    return join(old), join(new)
+
+
+def check_diffs(file_server, work_dir: Path, cases: int, seed: int, eol: str) -> dict[str, Any]:
+    rng = random.Random(seed)
+    path = work_dir / "p.txt"
+    failures = []
+    applied = 0
+    while applied < cases:
+        old, new = random_pair(rng, eol)
+        # new lines take the line ending of the file, a file without any has no style to keep
+        if old == new or (eol != "\n" and eol not in old):
+            continue
+        diff = unified_diff(old, new, rng.choice([0, 1, 3]))
+        path.write_text(old, encoding="utf-8", newline="")
+        result = file_server.patch_file(str(path), diff=diff)
+        got = read_exact(path)
+        if got != new and len(failures) < 5:
+            failures.append({"old": old, "new": new, "diff": diff, "got": got, "result": result})
+        applied += 1
+    return {"cases": applied, "failed": len(failures), "failures": failures}
+
+
+def check_edge_cases(file_server, work_dir: Path) -> dict[str, Any]:
+    """(file content, patch_file arguments, expected content or None when the patch must be rejected)"""
+    cases = [
+        ("a\r\nb\r\nc\r\n", {"edits": [{"start_line": 2, "end_line": 2, "content": "B\nB2", "expected": "b"}]}, "a\r\nB\r\nB2\r\nc\r\n"),
+        ("a\r\nb\r\n", {"diff": "@@ -1,2 +1,3 @@\n a\n+x\n b\n"}, "a\r\nx\r\nb\r\n"),
+        ("x\ny", {"edits": [{"start_line": 2, "end_line": 2, "content": "Y"}]}, "x\nY"),
+        ("x\ny", {"edits": [{"start_line": 3, "end_line": 2, "content": "z"}]}, "x\ny\nz\n"),
+        ("x\ny\nw", {"diff": "@@ -1 +1 @@\n-x\n+X\n"}, "X\ny\nw"),
+        ("x\ny", {"diff": "@@ -2 +2 @@\n-y\n\\ No newline at end of file\n+y\n"}, "x\ny\n"),
+        ("x\ny\n", {"diff": "@@ -2 +2 @@\n-y\n+y\n\\ No newline at end of file\n"}, "x\ny"),
+        ("a\nb\n", {"diff": "@@ -1,2 +1,2 @@\n a\n-nope\n+x\n"}, None),
+        ("a\nb\n", {"edits": [{"start_line": 1, "end_line": 1, "content": "x", "expected": "zzz"}]}, None),
+        ("a\nb\n", {"edits": [{"start_line": 9, "end_line": 9, "content": "x"}]}, None),
+        ("a\x0cb\nc\u2028d\n", {"edits": [{"start_line": 2, "end_line": 2, "content": "x\x85y", "expected": "c\u2028d"}]}, "a\x0cb\nx\x85y\n"),
+        ("a\x0cb\nc\n", {"diff": "@@ -1,2 +1,2 @@\n a\x0cb\n-c\n+x\u2028y\n"}, "a\x0cb\nx\u2028y\n"),
+    ]
+    path = work_dir / "edge.txt"
+    failures = []
+    for index, (content, arguments, expected) in enumerate(cases):
+        path.write_text(content, encoding="utf-8", newline="")
+        result = file_server.patch_file(str(path), **arguments)
+        got = read_exact(path)
+        # a rejected patch leaves the file as it was
+        if got != (content if expected is None else expected) or ("error" in result) != (expected is None):
+            failures.append({"case": index, "got": got, "result": result})
+    leftovers = [name for name in os.listdir(work_dir) if name.startswith(".edge.txt.")]
+    if leftovers:
+        failures.append({"temp_files_left": leftovers})
+    return {"cases": len(cases), "failed": len(failures), "failures": failures}
+
+
+def multibyte_file(path: Path, lines: int) -> str:
+    rng = random.Random(0)
+    text = "".join(
+        f"第{i}行 {'日志😀' * rng.randint(0, 30)}{'x' * rng.randint(0, 40)}\n" for i in range(1, lines + 1)
+    ) + "最后一行没有换行 ✓"
+    path.write_text(text, encoding="utf-8", newline="")
+    return text
+
+
+def check_cursors(file_server, work_dir: Path, lengths: list[int]) -> dict[str, Any]:
+    path = work_dir / "multibyte.txt"
+    text = multibyte_file(path, 500)
+    all_lines = text.splitlines(True)
+    failures = []
+    pages = 0
+    for length in lengths:
+        for offset in (0, 1, 2, 5):
+            # an offset inside a character starts at the next character
+            start = len(text.encode("utf-8")[offset:].decode("utf-8", errors="ignore").encode("utf-8"))
+            expected = text.encode("utf-8")[-start:].decode("utf-8") if start else ""
+            parts, result = [], file_server.read_file(str(path), offset=offset, length=length)
+            while "error" not in result:
+                parts.append(result["content"])
+                pages += 1
+                if not result["next_cursor"]:
+                    break
+                result = file_server.read_file(str(path), cursor=result["next_cursor"])
+            if "error" in result or "".join(parts) != expected:
+                failures.append({"mode": "bytes", "length": length, "offset": offset, "result": result.get("error")})
+        for start_line, end_line in ((1, None), (7, 42), (480, None), (501, 501)):
+            parts, result = [], file_server.read_file(str(path), start_line=start_line, end_line=end_line, length=length)
+            while "error" not in result:
+                parts.append(result["content"])
+                pages += 1
+                if not result["next_cursor"]:
+                    break
+                result = file_server.read_file(str(path), cursor=result["next_cursor"])
+            expected = "".join(all_lines[start_line - 1:end_line])
+            if "error" in result or "".join(parts) != expected:
+                failures.append({"mode": "lines", "length": length, "start_line": start_line, "result": result.get("error")})
+    return {"pages": pages, "failed": len(failures), "failures": failures[:5]}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=400, help="random diffs per line ending")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[4, 7, 64, 1000, 8192], help="cursor page sizes in bytes")
+    parser.add_argument("--output", type=str, help="write the json report here instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # the files written here stay out of the search index of the data directory
+        os.environ["BASE_DATA_DIR"] = work_dir
+        import file_server
+
+        work_dir = Path(work_dir)
+        report = {
+            "diffs_lf": check_diffs(file_server, work_dir, args.cases, args.seed, "\n"),
+            "diffs_crlf": check_diffs(file_server, work_dir, args.cases, args.seed, "\r\n"),
+            "edge_cases": check_edge_cases(file_server, work_dir),
+            "cursors": check_cursors(file_server, work_dir, args.lengths),
+        }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    sys.exit(1 if any(section["failed"] for section in report.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
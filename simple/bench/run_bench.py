@@ -0,0 +1,277 @@
+"""
+@Desc : offline end to end benchmark of the chat pipeline
+
+starts the fake llm and an sse mcp stand-in as subprocesses, a stdio stand-in through the
+server config, then runs the scripted turns at every concurrency level. every turn is split
+into llm time, tool time and framework overhead (prompt rendering, context fitting, tool
+call parsing, result formatting and transport glue). the report is json.
+
+    cd simple && python -m bench.run_bench --concurrency 1 8 32 --turns 5 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import aclosing
+from pathlib import Path
+from typing import Any
+
+from client import ChatSession, LLMClient, Server
+from media_store import MediaStore
+from result_processor import ToolResultProcessor
+
+BENCH_DIR = Path(__file__).resolve().parent
+
+
+class TurnTimer:
+    """wall time spent waiting on the llm and on tools during one turn"""
+    def __init__(self):
+        self.llm: float = 0.0
+        self.tool: float = 0.0
+        self._tools_in_flight: int = 0
+        self._tools_since: float = 0.0
+
+    def reset(self) -> None:
+        self.llm = self.tool = 0.0
+
+    def tool_started(self) -> None:
+        # parallel tool calls overlap, only the time any of them runs is counted
+        if self._tools_in_flight == 0:
+            self._tools_since = time.perf_counter()
+        self._tools_in_flight += 1
+
+    def tool_finished(self) -> None:
+        self._tools_in_flight -= 1
+        if self._tools_in_flight == 0:
+            self.tool += time.perf_counter() - self._tools_since
+
+
+class TimedLLMClient:
+    """llm client of one benchmark session, adds the time of every request to its timer"""
+    def __init__(self, llm_client: LLMClient, timer: TurnTimer):
+        self.llm_client: LLMClient = llm_client
+        self.timer: TurnTimer = timer
+
+    async def get_response(self, messages, timeout=None) -> str:
+        start = time.perf_counter()
+        try:
+            return await self.llm_client.get_response(messages, timeout)
+        finally:
+            self.timer.llm += time.perf_counter() - start
+
+    async def complete(self, messages, timeout=None) -> str:
+        start = time.perf_counter()
+        try:
+            return await self.llm_client.complete(messages, timeout)
+        finally:
+            self.timer.llm += time.perf_counter() - start
+
+    async def stream_response(self, messages, timeout=None):
+        start = time.perf_counter()
+        try:
+            async with aclosing(self.llm_client.stream_response(messages, timeout)) as stream:
+                async for delta in stream:
+                    yield delta
+        finally:
+            self.timer.llm += time.perf_counter() - start
+
+
+def timed_session(chat_session: ChatSession) -> tuple[ChatSession, TurnTimer]:
+    """fork a conversation whose llm requests and tool calls are timed"""
+    timer = TurnTimer()
+    session = chat_session.fork()
+    session.llm_client = TimedLLMClient(chat_session.llm_client, timer)
+    execute_tool = session.execute_tool
+
+    async def timed_execute_tool(tool_name: str, args: dict[str, Any]) -> Any:
+        timer.tool_started()
+        try:
+            return await execute_tool(tool_name, args)
+        finally:
+            timer.tool_finished()
+
+    session.execute_tool = timed_execute_tool
+    return session, timer
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, process: subprocess.Popen, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args} exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"nothing listening on port {port} after {timeout}s")
+
+
+def summarize(values: list[float]) -> dict[str, float]:
+    ordered = sorted(values)
+
+    def percentile(p: float) -> float:
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+
+    return {
+        "mean": statistics.fmean(ordered),
+        "p50": percentile(0.5),
+        "p95": percentile(0.95),
+        "max": ordered[-1],
+    }
+
+
+async def run_level(chat_session: ChatSession, concurrency: int, turns: int, stream: bool) -> dict[str, Any]:
+    """run `turns` turns in each of `concurrency` conversations at the same time"""
+    samples: list[dict[str, float]] = []
+    rounds: list[int] = []
+
+    async def conversation() -> None:
+        session, timer = timed_session(chat_session)
+        await session.reset_session()
+        for turn in range(turns):
+            tool_rounds: list[str] = []
+            timer.reset()
+            start = time.perf_counter()
+            await session.run_turn(
+                f"第{turn}轮: 请调用工具",
+                on_token=(lambda token: None) if stream else None,
+                on_tool_results=tool_rounds.append,
+                max_tool_rounds=10,
+            )
+            total = time.perf_counter() - start
+            samples.append({
+                "total": total,
+                "llm": timer.llm,
+                "tool": timer.tool,
+                "overhead": total - timer.llm - timer.tool,
+            })
+            rounds.append(len(tool_rounds))
+        await session.close_session()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(conversation() for _ in range(concurrency)))
+    wall_time = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "turns": len(samples),
+        "tool_rounds_per_turn": statistics.fmean(rounds),
+        "wall_time": wall_time,
+        "throughput_turns_per_s": len(samples) / wall_time,
+        "latency": {key: summarize([sample[key] for sample in samples]) for key in ("total", "llm", "tool", "overhead")},
+    }
+
+
+async def run(args, llm_port: int, sse_port: int, work_dir: Path) -> dict[str, Any]:
+    servers = [
+        Server("stdio_tools", {
+            "command": sys.executable,
+            "args": [str(BENCH_DIR / "mcp_standin.py"), "--prefix", "stdio_", "--latency", str(args.tool_latency)],
+            "pool_size": args.pool_size,
+        }),
+        Server("sse_tools", {"url": f"http://127.0.0.1:{sse_port}/sse", "pool_size": args.pool_size}),
+    ]
+    llm_client = LLMClient(
+        api_key="bench",
+        base_url=f"http://127.0.0.1:{llm_port}/v1",
+        model="bench",
+        max_connections=max(args.concurrency) * 2,
+        max_keepalive_connections=max(args.concurrency),
+    )
+    chat_session = ChatSession(
+        llm_client,
+        servers,
+        max_parallel_tools=args.max_parallel_tools,
+        result_processor=ToolResultProcessor(spill_dir=work_dir / "spill"),
+        media_store=MediaStore(work_dir / "media"),
+    )
+    start = time.perf_counter()
+    await chat_session.start_session()
+    startup_time = time.perf_counter() - start
+    try:
+        # one warm up turn so connection setup is not measured
+        await run_level(chat_session, 1, 1, args.stream)
+        results = [await run_level(chat_session, level, args.turns, args.stream) for level in args.concurrency]
+    finally:
+        await chat_session.close_session()
+        await LLMClient.close_http_client()
+    return {
+        "config": {
+            "concurrency": args.concurrency,
+            "turns": args.turns,
+            "stream": args.stream,
+            "llm_latency": args.llm_latency,
+            "token_latency": args.token_latency,
+            "tool_latency": args.tool_latency,
+            "pool_size": args.pool_size,
+            "max_parallel_tools": args.max_parallel_tools,
+        },
+        "startup_time": startup_time,
+        "results": results,
+    }
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="concurrent conversations")
+    parser.add_argument("--turns", type=int, default=5, help="turns per conversation")
+    parser.add_argument("--stream", action="store_true", help="stream llm responses")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds before the first llm byte")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--tool-latency", type=float, default=0.01, help="seconds every tool call takes")
+    parser.add_argument("--script", type=str, help="json file with the scripted llm responses")
+    parser.add_argument("--pool-size", type=int, default=1, help="connections per mcp server")
+    parser.add_argument("--max-parallel-tools", type=int, default=4)
+    parser.add_argument("--output", type=str, help="write the json report here instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.WARNING)
+    llm_port, sse_port = free_port(), free_port()
+    llm_command = [
+        sys.executable, "-m", "bench.fake_llm", "--port", str(llm_port),
+        "--latency", str(args.llm_latency), "--token-latency", str(args.token_latency),
+    ]
+    if args.script:
+        llm_command += ["--script", args.script]
+    sse_command = [
+        sys.executable, str(BENCH_DIR / "mcp_standin.py"), "--prefix", "sse_",
+        "--latency", str(args.tool_latency), "--transport", "sse", "--port", str(sse_port),
+    ]
+    processes = [
+        subprocess.Popen(llm_command, cwd=BENCH_DIR.parent),
+        subprocess.Popen(sse_command, cwd=BENCH_DIR.parent),
+    ]
+    try:
+        wait_for_port(llm_port, processes[0])
+        wait_for_port(sse_port, processes[1])
+        with tempfile.TemporaryDirectory() as work_dir:
+            report = asyncio.run(run(args, llm_port, sse_port, Path(work_dir)))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
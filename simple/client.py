@@ -2,18 +2,36 @@
 @Desc : borrowed from modelcontextprotocol/python-sdk
 """
 import os
+import shutil
 import asyncio
 import httpx
 import json
+import copy
+import base64
+import hashlib
+import time
+import random
+import anyio
+import importlib
 from dotenv import load_dotenv
+from openai import AsyncOpenAI
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
-from mcp.types import CallToolResult
+from mcp.types import CallToolResult, Implementation, ServerNotification, TextContent, ToolListChangedNotification
 from mcp.client.sse import sse_client
-from typing import Any, Union
+from mcp.shared.memory import create_client_server_memory_streams
+from mcp.shared.exceptions import McpError
+from typing import Any, AsyncIterator, Callable, Container, Union
 from pathlib import Path
-from contextlib import AsyncExitStack
+from contextlib import AsyncExitStack, aclosing, asynccontextmanager
+from collections import OrderedDict
 import logging
+import re
+from attachments import Attachment
+from context_window import ConversationWindow, count_message_tokens, count_text_tokens
+from media_store import MediaStore
+from result_processor import READ_RESULT_TOOL, READ_RESULT_TOOL_SCHEMA, ToolResultProcessor
+from tracing import tracer
 
 class ToolNotFoundError(Exception):
     """Exception raised when a tool is not found."""
@@ -28,6 +46,10 @@ class Configration:
         self.api_key = os.getenv("LLM_API_KEY")
         self.base_url = os.getenv("LLM_BASE_URL")
         self.model_id = os.getenv("LLM_MODEL")
+        # http pool and per request timeout of the llm client
+        self.timeout = float(os.getenv("LLM_TIMEOUT", "60"))
+        self.max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+        self.max_keepalive_connections = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "10"))
     
     @staticmethod
     def load_env():
@@ -67,7 +89,18 @@ class Tool:
         self.description = description
         self.function: dict[str, Any] = function
     
-    def format_tool(self):
+    def to_dict(self) -> dict[str, Any]:
+        return {"name": self.name, "description": self.description, "inputSchema": self.function}
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "Tool":
+        return cls(data["name"], data.get("description"), data.get("inputSchema", {}))
+
+    def format_tool(self, name: str | None = None):
+        """format tool for the system prompt
+        Args:
+            name: name exposed to the llm, defaults to the tool name
+        """
         args_desc = []
         if "properties" in self.function:
             for param_name, param_info in self.function["properties"].items():
@@ -79,22 +112,316 @@ class Tool:
                 args_desc.append(arg_desc)
                 
         return f"""
-            "name": {self.name},
+            "name": {name or self.name},
             "description": {self.description},
             "arguments": {chr(10).join(args_desc)}
         """
 
+class ServerUnavailableError(Exception):
+    """Exception raised when the circuit breaker of a server is open."""
+    def __init__(self, server_name: str):
+        self.server_name = server_name
+        super().__init__(f"Server {server_name} is unavailable")
+
+class RetryPolicy:
+    """exponential backoff with full jitter, bounded by a per call deadline"""
+    # transport level failures worth another attempt, tool errors are not retried
+    RETRYABLE_ERRORS: tuple[type[BaseException], ...] = (
+        ConnectionError,
+        TimeoutError,
+        OSError,
+        httpx.TransportError,
+        anyio.ClosedResourceError,
+        anyio.BrokenResourceError,
+        anyio.EndOfStream,
+    )
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.2, max_delay: float = 5.0, deadline: float = 60.0):
+        self.max_attempts: int = max_attempts
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.deadline: float = deadline
+
+    def is_retryable(self, err: BaseException) -> bool:
+        if isinstance(err, McpError):
+            return err.error.code == httpx.codes.REQUEST_TIMEOUT
+        return isinstance(err, self.RETRYABLE_ERRORS)
+
+    def backoff(self, attempt: int) -> float:
+        """delay before the next attempt, attempt counts from 1"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+class CircuitBreaker:
+    """open after consecutive failures, closed again by a successful probe"""
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold: int = failure_threshold
+        # seconds between background health probes while open
+        self.reset_timeout: float = reset_timeout
+        self.failures: int = 0
+        self.is_open: bool = False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.is_open = False
+
+    def record_failure(self) -> bool:
+        """return True when this failure opens the breaker"""
+        self.failures += 1
+        if not self.is_open and self.failures >= self.failure_threshold:
+            self.is_open = True
+            return True
+        return False
+
+class ToolResultCache:
+    """LRU cache with ttl for the results of one idempotent tool"""
+    def __init__(self, ttl: float = 300.0, max_entries: int = 128, max_bytes: int = 8 * 1024 * 1024):
+        self.ttl: float = ttl
+        self.max_entries: int = max_entries
+        self.max_bytes: int = max_bytes
+        # key -> (expires at, size, result)
+        self._entries: OrderedDict[str, tuple[float, int, Any]] = OrderedDict()
+        self._bytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    @staticmethod
+    def make_key(server_name: str, tool_name: str, arguments: dict[str, Any]) -> str:
+        """canonicalize arguments so equal calls share a key regardless of argument order"""
+        return json.dumps([server_name, tool_name, arguments], sort_keys=True, ensure_ascii=False, default=repr)
+
+    def get(self, key: str) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, key: str, result: Any, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, result)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+@asynccontextmanager
+async def in_process_transport(module_name: str, attribute: str = "mcp"):
+    """serve the FastMCP instance `attribute` of `module_name` in this event loop over memory streams
+
+    there is no process or pipe in between, but synchronous tools run on the event loop,
+    so only trusted tools that return quickly should be served this way.
+    """
+    server = getattr(importlib.import_module(module_name), attribute)
+    # a FastMCP wraps a low level server, which is what speaks the protocol
+    server = getattr(server, "_mcp_server", server)
+    async with create_client_server_memory_streams() as (client_streams, server_streams):
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(
+                server.run, *server_streams, server.create_initialization_options()
+            )
+            try:
+                yield client_streams
+            finally:
+                task_group.cancel_scope.cancel()
+
+
+class ServerConnection:
+    """one transport and ClientSession of a server, owned by a dedicated task
+
+    the transport and session contexts are entered and exited inside that task,
+    so connections can be started concurrently and closed from any task.
+    """
+    def __init__(self, server: "Server", index: int):
+        self.server: "Server" = server
+        self.index: int = index
+        self.session: ClientSession | None = None
+        # tool calls currently running on this connection
+        self.in_flight: int = 0
+        # cleared by a transport failure, set again by a successful probe
+        self.healthy: bool = True
+        self._task: asyncio.Task | None = None
+        self._shutdown: asyncio.Event = asyncio.Event()
+
+    async def start(self) -> None:
+        ready: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._run(ready), name=f"mcp-server-{self.server.name}-{self.index}")
+        # shield the future, a timeout on start must not cancel it under the lifecycle task
+        await asyncio.shield(ready)
+
+    async def _run(self, ready: asyncio.Future) -> None:
+        """own the connection until close is requested"""
+        exit_stack = AsyncExitStack()
+        try:
+            try:
+                self.session = await self.server._connect(exit_stack)
+            except Exception as e:
+                if not ready.done():
+                    ready.set_exception(RuntimeError(f"Failed to start server: {e}"))
+                return
+            if not ready.done():
+                ready.set_result(None)
+            await self._shutdown.wait()
+        finally:
+            self.session = None
+            try:
+                await exit_stack.aclose()
+            except Exception as e:
+                logging.warning(f"Warning closing exit stack for {self.server.name}: {e}")
+            if not ready.done():
+                # closed during startup, the caller already gave up on it
+                ready.cancel()
+
+    async def close(self) -> None:
+        task, self._task = self._task, None
+        if task is None:
+            return
+        if self.session is None:
+            # still connecting, abort the handshake
+            task.cancel()
+        else:
+            self._shutdown.set()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.warning(f"Warning closing server {self.server.name}: {e}")
+
 class Server:
     """manage mcp server connection and tool execution"""
+    # seconds to wait for a server handshake before it is skipped
+    DEFAULT_STARTUP_TIMEOUT = 30.0
+    # tools with side effects, never cached, running one drops the cached results of its server
+    SIDE_EFFECT_TOOLS = {"write_file", "append_file", "write_files", "patch_file"}
+
     def __init__(self, name: str, config: dict[str, Any]):
         self.name: str = name
         self.config: dict[str, Any] = config
-        self.stdio_context: Any | None = None
-        self.session: ClientSession | None = None
+        # number of sessions (worker processes for stdio servers), calls go to the least busy one
+        self.pool_size: int = max(int(config.get("pool_size", 1)), 1)
+        self.connections: list[ServerConnection] = []
+        # serverInfo reported by the initialize handshake
+        self.server_info: Implementation | None = None
+        self.startup_timeout: float = float(config.get("startup_timeout", self.DEFAULT_STARTUP_TIMEOUT))
+        # servers with higher priority win tool name conflicts
+        self.priority: int = int(config.get("priority", 0))
+        # opt-in result caches, configured per tool by "resultCache": {"<tool>": {"ttl", "max_entries", "max_bytes"}}
+        self.result_caches: dict[str, ToolResultCache] = {}
+        for tool_name, cache_config in config.get("resultCache", {}).items():
+            if tool_name in self.SIDE_EFFECT_TOOLS:
+                logging.warning(f"Tool {tool_name} of server {name} has side effects, result cache ignored")
+                continue
+            self.result_caches[tool_name] = ToolResultCache(**cache_config)
+        # "retry": {"max_attempts", "base_delay", "max_delay", "deadline"}
+        self.retry_policy: RetryPolicy = RetryPolicy(**config.get("retry", {}))
+        # "circuitBreaker": {"failure_threshold", "reset_timeout"}
+        self.breaker: CircuitBreaker = CircuitBreaker(**config.get("circuitBreaker", {}))
+        self._probe_task: asyncio.Task | None = None
+        # lazy servers are spawned on their first tool call and stopped after idle_timeout seconds
+        self.lazy: bool = bool(config.get("lazy", False))
+        self.idle_timeout: float = float(config.get("idle_timeout", 300.0))
+        self.last_used: float = time.monotonic()
+        self._start_lock: asyncio.Lock = asyncio.Lock()
+        self._reaper_task: asyncio.Task | None = None
         self._cleanup_lock: asyncio.Lock = asyncio.Lock()
-        self.exit_stack: AsyncExitStack = AsyncExitStack()
-    
+        # called when the server sends notifications/tools/list_changed
+        self.on_tools_changed: Callable[["Server"], None] | None = None
+
+    @property
+    def config_hash(self) -> str:
+        return hashlib.sha256(json.dumps(self.config, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @property
+    def version(self) -> str | None:
+        return self.server_info.version if self.server_info else None
+
+    @property
+    def session(self) -> ClientSession | None:
+        """session of the first connected pool member, used for requests other than tool calls"""
+        for connection in self.connections:
+            if connection.session is not None:
+                return connection.session
+        return None
+
     async def initialize(self):
+        """start pool_size connections concurrently, members that fail to start are dropped"""
+        if self.connections:
+            raise RuntimeError(f"Server {self.name} is already initialized.")
+        self.connections = [ServerConnection(self, index) for index in range(self.pool_size)]
+        with tracer.span("server.initialize", server=self.name, pool_size=self.pool_size) as span:
+            results = await asyncio.gather(
+                *(connection.start() for connection in self.connections), return_exceptions=True
+            )
+            span.set(failed=sum(isinstance(result, BaseException) for result in results))
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if len(errors) == len(results):
+            await self.cleanup()
+            raise errors[0]
+        for connection, result in zip(list(self.connections), results):
+            if isinstance(result, BaseException):
+                logging.warning(f"Pool member {connection.index} of server {self.name} failed to start: {result}")
+                self.connections.remove(connection)
+        self.last_used = time.monotonic()
+        if self.lazy:
+            self._reaper_task = asyncio.create_task(self._reap_when_idle())
+
+    @property
+    def is_running(self) -> bool:
+        """connected and ready for requests"""
+        return self.session is not None
+
+    async def ensure_started(self) -> None:
+        """spawn a lazy server that is not running"""
+        async with self._start_lock:
+            self.last_used = time.monotonic()
+            if self.connections:
+                return
+            logging.info(f"Starting server {self.name} on demand")
+            try:
+                await asyncio.wait_for(self.initialize(), timeout=self.startup_timeout)
+            except asyncio.TimeoutError:
+                await self.cleanup()
+                raise RuntimeError(f"Server {self.name} not ready within {self.startup_timeout}s")
+
+    async def _reap_when_idle(self) -> None:
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            async with self._start_lock:
+                busy = any(connection.in_flight for connection in self.connections)
+                if busy or time.monotonic() - self.last_used < self.idle_timeout:
+                    continue
+                logging.info(f"Stopping server {self.name} after {self.idle_timeout}s idle")
+                # do not cancel ourselves from cleanup
+                self._reaper_task = None
+                await self.cleanup()
+                return
+
+    async def _connect(self, exit_stack: AsyncExitStack) -> ClientSession:
         if self.config.get("command"):
             command = (
                 shutil.which("npx")
@@ -103,156 +430,640 @@ class Server:
             )
             if command is None:
                 raise ValueError(f"Command 'None' not found.")
-            
+
             server_params = StdioServerParameters(
                 command=command,
-                args=self.config['args'],
+                args=self.config.get('args', []),
                 env={**os.environ, **self.config.get('env', {})}
 
             )
-
-            try:
-                stdio_tansport = await self.exit_stack.enter_async_context(
-                    stdio_client(server_params)
-                )
-                read, write = stdio_tansport
-                session = await self.exit_stack.enter_async_context(
-                    ClientSession(read, write)
-                )
-                await session.initialize()
-                self.session = session
-            except Exception as e:
-                await self.cleanup()
-                raise RuntimeError(f"Failed to start server: {e}")
+            read, write = await exit_stack.enter_async_context(
+                stdio_client(server_params)
+            )
         elif self.config.get("url"):
-            url = self.config['url']
-            try:
-                sse_transport = await self.exit_stack.enter_async_context(
-                    sse_client(url=url)
-                )
-                read, write = sse_transport
-                session = await self.exit_stack.enter_async_context(
-                    ClientSession(read, write)
-                )
-                await session.initialize()
-                self.session = session
-            except Exception as e:
-                await self.cleanup()
-                raise RuntimeError(f"Failed to start server: {e}")
+            read, write = await exit_stack.enter_async_context(
+                sse_client(url=self.config['url'])
+            )
+        elif self.config.get("module"):
+            # "module": "<importable module>", "attribute": "<FastMCP instance>", defaults to "mcp"
+            if self.config.get("env"):
+                logging.warning(f"Server {self.name} runs in process, its 'env' is ignored")
+            read, write = await exit_stack.enter_async_context(
+                in_process_transport(self.config["module"], self.config.get("attribute", "mcp"))
+            )
+        else:
+            raise ValueError(f"Server {self.name} has none of 'command', 'url' or 'module' configured.")
+        session = await exit_stack.enter_async_context(
+            ClientSession(read, write, message_handler=self._handle_message)
+        )
+        init_result = await session.initialize()
+        self.server_info = init_result.serverInfo
+        return session
+
+    async def _handle_message(self, message: Any) -> None:
+        if isinstance(message, ServerNotification) and isinstance(message.root, ToolListChangedNotification):
+            logging.info(f"Tools of server {self.name} changed")
+            if self.on_tools_changed:
+                self.on_tools_changed(self)
+
     async def cleanup(self) -> None:
         """Clean up server resources safely with proper resource teardown order."""
         async with self._cleanup_lock:
-            # 先关闭session
-            if self.session:
-                try:
-                    await self.session.close()
-                except Exception as e:
-                    logging.warning(f"Warning closing session for {self.name}: {e}")
-                finally:
-                    self.session = None
-            
-            # 然后关闭stdio_context
-            if self.stdio_context:
-                try:
-                    await self.stdio_context.__aexit__(None, None, None)
-                except Exception as e:
-                    logging.warning(f"Warning closing stdio context for {self.name}: {e}")
-                finally:
-                    self.stdio_context = None
-            
-            # 最后处理exit_stack
-            if self.exit_stack:
-                try:
-                    await self.exit_stack.aclose()
-                except Exception as e:
-                    logging.warning(f"Warning closing exit stack for {self.name}: {e}")
-                finally:
-                    self.exit_stack = None
-    
+            if self._probe_task:
+                self._probe_task.cancel()
+                self._probe_task = None
+            if self._reaper_task:
+                self._reaper_task.cancel()
+                self._reaper_task = None
+            connections, self.connections = self.connections, []
+            await asyncio.gather(*(connection.close() for connection in connections))
+
+    def _pick_connection(self) -> ServerConnection:
+        """the least busy healthy member, or any connected member when none is healthy"""
+        connected = [connection for connection in self.connections if connection.session is not None]
+        if not connected:
+            if self.connections:
+                # every member lost its transport, the probe reconnects them
+                self._start_probe()
+            raise RuntimeError(f"Server {self.name} is not initialized.")
+        healthy = [connection for connection in connected if connection.healthy]
+        return min(healthy or connected, key=lambda connection: connection.in_flight)
+
     async def list_tools(self) -> list[Any]:
         if not self.session:
             raise RuntimeError(f"Server {self.name} is not initialized.")
 
-        tools = await self.session.list_tools()
-        tools_list = []
+        with tracer.span("server.list_tools", server=self.name) as span:
+            tools = await self.session.list_tools()
+            tools_list = []
 
-        for item in tools:
-            if isinstance(item, tuple) and item[0] == "tools":
-                for tool in item[1]:
-                    tools_list.append(Tool(tool.name, tool.description, tool.inputSchema))
+            for item in tools:
+                if isinstance(item, tuple) and item[0] == "tools":
+                    for tool in item[1]:
+                        tools_list.append(Tool(tool.name, tool.description, tool.inputSchema))
+            span.set(tools=len(tools_list))
         return tools_list
     
-    async def excute_tool(self, tool_name: str, input_: dict[str, Any], retry: int = 3, delay: float = 1.0) -> Any:
-        if not self.session:
-            raise RuntimeError(f"Server {self.name} is not initialized.")
-        
+    def cache_stats(self) -> dict[str, dict[str, int]]:
+        """hit/miss counters of the result cache of every cached tool"""
+        return {tool_name: cache.stats() for tool_name, cache in self.result_caches.items()}
+
+    async def excute_tool(self, tool_name: str, input_: dict[str, Any], deadline: float | None = None) -> Any:
+        """call a tool, retrying transient failures
+
+        Args:
+            deadline: seconds for all attempts together, defaults to the retry policy deadline
+
+        Raises:
+            ServerUnavailableError: the circuit breaker of the server is open.
+        """
+        with tracer.span("server.call_tool", server=self.name, tool=tool_name) as span:
+            if self.lazy:
+                await self.ensure_started()
+            if not self.session:
+                raise RuntimeError(f"Server {self.name} is not initialized.")
+
+            cache = self.result_caches.get(tool_name)
+            if cache is None:
+                if tool_name in self.SIDE_EFFECT_TOOLS:
+                    for result_cache in self.result_caches.values():
+                        result_cache.clear()
+                return await self._call_tool(tool_name, input_, deadline)
+            key = ToolResultCache.make_key(self.name, tool_name, input_)
+            result = cache.get(key)
+            span.set(cache_hit=result is not None)
+            if result is not None:
+                logging.info(f"Tool {tool_name} served from result cache")
+                return result
+            result = await self._call_tool(tool_name, input_, deadline)
+            if not getattr(result, "isError", False):
+                cache.put(key, result, len(result.model_dump_json()))
+            return result
+
+    async def _call_tool(self, tool_name: str, input_: dict[str, Any], deadline: float | None) -> Any:
+        if self.breaker.is_open:
+            raise ServerUnavailableError(self.name)
+        policy = self.retry_policy
+        deadline_at = time.monotonic() + (deadline if deadline is not None else policy.deadline)
         attempt = 0
-        while attempt<retry:
+        while True:
+            attempt += 1
+            connection = self._pick_connection()
+            connection.in_flight += 1
             try:
                 logging.info(f"Executing tool {tool_name}")
-                result = await self.session.call_tool(tool_name, input_)
+                result = await asyncio.wait_for(
+                    connection.session.call_tool(tool_name, input_),
+                    timeout=max(deadline_at - time.monotonic(), 0),
+                )
+                span = tracer.current_span()
+                if span is not None:
+                    span.set(attempts=attempt, connection=connection.index)
+                self.breaker.record_success()
                 return result
             except Exception as err:
-                attempt += 1
-                if attempt < retry:
-                    logging.info(f"Retrying in {delay} seconds...")
-                    await asyncio.sleep(delay)
-                else:
-                    logging.error(
-                        f"Error executing tool: {e}."
-                    )
-                    raise RuntimeError(f"Failed to execute tool {tool_name} after {retry} attempts: {err}")
+                reason = str(err) or type(err).__name__
+                if not policy.is_retryable(err):
+                    logging.error(f"Error executing tool: {reason}.")
+                    raise RuntimeError(f"Failed to execute tool {tool_name}: {reason}") from err
+                # the next attempt goes to another member while this one is probed
+                connection.healthy = False
+                self._start_probe()
+                delay = policy.backoff(attempt)
+                if attempt >= policy.max_attempts or time.monotonic() + delay >= deadline_at:
+                    logging.error(f"Error executing tool: {reason}.")
+                    if self.breaker.record_failure():
+                        logging.warning(f"Circuit breaker of server {self.name} opened")
+                    raise RuntimeError(f"Failed to execute tool {tool_name} after {attempt} attempts: {reason}") from err
+                logging.info(f"Retrying in {delay:.2f} seconds...")
+                await asyncio.sleep(delay)
+            finally:
+                connection.in_flight -= 1
+                self.last_used = time.monotonic()
+
+    def _start_probe(self) -> None:
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.create_task(self._probe())
+
+    async def _probe(self) -> None:
+        """check unhealthy members in the background until they answer, then close the breaker
+
+        a member that does not answer a ping (its process died or its transport broke) is
+        closed and a new connection is started in its place.
+        """
+        while self.breaker.is_open or any(
+            not connection.healthy or connection.session is None for connection in self.connections
+        ):
+            await asyncio.sleep(self.breaker.reset_timeout)
+            for connection in list(self.connections):
+                if connection.healthy and connection.session is not None:
+                    continue
+                if connection.session is not None:
+                    try:
+                        await asyncio.wait_for(connection.session.send_ping(), timeout=self.breaker.reset_timeout)
+                    except Exception as e:
+                        logging.info(f"Pool member {connection.index} of server {self.name} does not answer: {e}, reconnecting")
+                    else:
+                        self._member_recovered(connection)
+                        continue
+                replacement = await self._replace_connection(connection)
+                if replacement is not None:
+                    self._member_recovered(replacement)
+
+    async def _replace_connection(self, connection: ServerConnection) -> ServerConnection | None:
+        """close a broken member and start a new connection in its slot, None if it fails to start"""
+        await connection.close()
+        replacement = ServerConnection(self, connection.index)
+        try:
+            await asyncio.wait_for(replacement.start(), timeout=self.startup_timeout)
+        except asyncio.CancelledError:
+            await replacement.close()
+            raise
+        except Exception as e:
+            await replacement.close()
+            logging.info(f"Pool member {connection.index} of server {self.name} failed to restart: {e}")
+            return None
+        if connection not in self.connections:
+            # the server was cleaned up meanwhile
+            await replacement.close()
+            return None
+        self.connections[self.connections.index(connection)] = replacement
+        return replacement
+
+    def _member_recovered(self, connection: ServerConnection) -> None:
+        connection.healthy = True
+        if self.breaker.is_open:
+            logging.info(f"Server {self.name} is healthy again, circuit breaker closed")
+            self.breaker.record_success()
 
 class LLMClient:
-    def __init__(self, api_key: str, base_url: str, model: str) -> None:
+    """async llm client, every instance shares one pooled http client per process"""
+    _http_client: httpx.AsyncClient | None = None
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        model: str,
+        timeout: float = 60.0,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+    ) -> None:
         self.api_key: str = api_key
         self.base_url: str = base_url
         self.model: str = model
+        self.timeout: float = timeout
+        self.max_connections: int = max_connections
+        self.max_keepalive_connections: int = max_keepalive_connections
+        self._client: AsyncOpenAI | None = None
+        self._client_http: httpx.AsyncClient | None = None
 
-    def get_response(self, messages: list[dict[str, str]]) -> str:
+    @classmethod
+    def shared_http_client(cls, max_connections: int = 20, max_keepalive_connections: int = 10) -> httpx.AsyncClient:
+        """return the process wide http client, the pool limits of the first caller win"""
+        if cls._http_client is None or cls._http_client.is_closed:
+            cls._http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive_connections,
+                ),
+                timeout=httpx.Timeout(60.0, connect=10.0),
+            )
+        return cls._http_client
+
+    @classmethod
+    async def close_http_client(cls) -> None:
+        """close the shared http client, call once when the process is done with llm calls"""
+        if cls._http_client is not None:
+            await cls._http_client.aclose()
+            cls._http_client = None
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        http_client = self.shared_http_client(self.max_connections, self.max_keepalive_connections)
+        if self._client is None or self._client_http is not http_client:
+            self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, http_client=http_client)
+            self._client_http = http_client
+        return self._client
+
+    async def get_response(self, messages: list[dict[str, str]], timeout: float | None = None) -> str:
         """Get a response from the LLM.
 
         Args:
             messages: A list of message dictionaries.
+            timeout: Request timeout in seconds, defaults to the client timeout.
 
         Returns:
             The LLM's response as a string.
+        """
+        try:
+            return await self.complete(messages, timeout)
+        except Exception as e:
+            error_message = f"Error getting LLM response: {str(e)}"
+            logging.error(error_message)
+            return error_message
+
+    async def complete(self, messages: list[dict[str, str]], timeout: float | None = None) -> str:
+        """like get_response, but errors are raised instead of returned as text
 
         Raises:
-            httpx.RequestError: If the request to the LLM fails.
+            openai.APIError: If the request to the LLM fails.
         """
-        from openai import OpenAI
-        client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-        payload = {
+        with tracer.span("llm.request", model=self.model, stream=False, messages=len(messages)) as span:
+            response = await self.client.chat.completions.create(
+                **self._payload(messages, stream=False),
+                timeout=timeout if timeout is not None else self.timeout,
+            )
+            content = response.choices[0].message.content
+            if response.usage is not None:
+                span.set(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+            elif tracer.enabled:
+                span.set(prompt_tokens=count_message_tokens(messages), completion_tokens=count_text_tokens(content or ""))
+        return content
+
+    async def stream_response(self, messages: list[dict[str, str]], timeout: float | None = None) -> AsyncIterator[str]:
+        """Stream a response from the LLM as content deltas.
+
+        Closing the iterator early closes the underlying http stream.
+
+        Raises:
+            openai.APIError: If the request to the LLM fails.
+        """
+        # not made current, the generator is suspended in the caller's context between chunks
+        span = tracer.start_span("llm.request", model=self.model, stream=True, messages=len(messages))
+        deltas: list[str] = []
+        error: BaseException | None = None
+        try:
+            stream = await self.client.chat.completions.create(
+                **self._payload(messages, stream=True),
+                timeout=timeout if timeout is not None else self.timeout,
+            )
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if tracer.enabled:
+                            deltas.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+            finally:
+                await stream.close()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if tracer.enabled:
+                # streamed chunks carry no usage, the counts are estimated
+                span.set(
+                    prompt_tokens=count_message_tokens(messages),
+                    completion_tokens=count_text_tokens("".join(deltas)),
+                    estimated=True,
+                )
+            span.end(error)
+
+    def _payload(self, messages: list[dict[str, str]], stream: bool) -> dict[str, Any]:
+        return {
             "messages": messages,
             "model": self.model,
             "temperature": 0.7,
             "max_tokens": 4096,
             "top_p": 1,
-            "stream": False,
+            "stream": stream,
             "stop": None,
         }
 
+class JsonObjectScanner:
+    """incrementally find where a json object or array closes in a stream of text"""
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> int:
+        """return the index in text right after the closing bracket, or -1 if still open"""
+        for i, ch in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    return i + 1
+        return -1
+
+class FencedToolCallFilter:
+    """pass streamed prose on to a callback, holding back ```json blocks until they close
+
+    a fenced json value that is a call of a known tool is never shown, feed reports where
+    it ends so the stream can be closed; any other fenced block is released once it is
+    known not to be one, and the rest of the prose as soon as it arrives.
+    """
+    FENCE = "```"
+
+    def __init__(self, on_token: Callable[[str], None], tool_names: Container[str]):
+        self.on_token: Callable[[str], None] = on_token
+        self.tool_names: Container[str] = tool_names
+        # text not emitted yet, it starts with a fence while one is held
+        self.pending: str = ""
+        # inside a released code block, the next fence closes it
+        self.in_block: bool = False
+        # scanner of the fenced json value, the index it starts at and how far it was fed
+        self.scanner: JsonObjectScanner | None = None
+        self.value_start: int = 0
+        self.fed: int = 0
+
+    def feed(self, text: str) -> int:
+        """return the index in text right after a fenced tool call, or -1"""
+        self.pending += text
+        while self.pending:
+            if self.scanner is not None:
+                end = self.scanner.feed(self.pending[self.fed:])
+                if end < 0:
+                    self.fed = len(self.pending)
+                    return -1
+                end += self.fed
+                if _parses_to_tool_call(self.pending[self.value_start:end], self.tool_names):
+                    # the value closes inside the text just fed
+                    return len(text) - (len(self.pending) - end)
+                self.scanner = None
+                self.in_block = True
+                self._emit(end)
+                continue
+            start = self.pending.find(self.FENCE)
+            if start < 0:
+                # trailing backticks may be the beginning of a fence
+                self._emit(len(self.pending.rstrip("`")))
+                return -1
+            if self.in_block:
+                self.in_block = False
+                self._emit(start + len(self.FENCE))
+                continue
+            self._emit(start)
+            newline = self.pending.find("\n")
+            if newline < 0:
+                return -1
+            info = self.pending[len(self.FENCE):newline].strip().lower()
+            body = self.pending[newline + 1:].lstrip()
+            if info in ("", "json") and (not body or (body[0] in "{[" and not body[1:].strip())):
+                # wait for the first characters of the block
+                return -1
+            self.in_block = True
+            if info not in ("", "json") or not _TOOL_CALL_START.match(body):
+                self._emit(newline + 1)
+                continue
+            self.value_start = self.fed = len(self.pending) - len(body)
+            self.scanner = JsonObjectScanner()
+        return -1
+
+    def flush(self) -> None:
+        """emit whatever is still held, at the end of the stream"""
+        self.scanner = None
+        self._emit(len(self.pending))
+
+    def _emit(self, end: int) -> None:
+        if end > 0:
+            self.on_token(self.pending[:end])
+            self.pending = self.pending[end:]
+
+
+# characters that matter when looking for json in free text
+_JSON_TOKEN = re.compile(r'[{}\[\]"\\]')
+# how a response that is nothing but a tool call (or an array of them) begins
+_TOOL_CALL_START = re.compile(r'\{\s*"|\[\s*\{')
+
+
+class _BracketScan:
+    """string state and open brackets shared by scans that agree on where strings are"""
+    def __init__(self):
+        self.in_string = False
+        self.escaped_at = -1
+        self.depth = 0
+        # depth outside the bracket -> offsets of the open brackets at that depth
+        self.open: dict[int, list[int]] = {}
+
+    def merge(self, other: "_BracketScan") -> "_BracketScan":
+        """take over the open brackets of a scan in the same state, the larger one is kept"""
+        if len(other.open) > len(self.open):
+            return other.merge(self)
+        shift = self.depth - other.depth
+        for depth, starts in other.open.items():
+            self.open.setdefault(depth + shift, []).extend(starts)
+        return self
+
+
+def _json_value_ends(text: str) -> dict[int, int]:
+    """map every bracket in text to the index right after the bracket closing it
+
+    the ends are the ones a scan started at each bracket on its own would find, in a single
+    pass: such scans only differ in where they see strings, and the ones that agree are
+    tracked together, so at most a few scans run side by side. a bracket that never closes
+    has no entry.
+    """
+    ends: dict[int, int] = {}
+    scans: list[_BracketScan] = []
+    for match in _JSON_TOKEN.finditer(text):
+        i = match.start()
+        ch = text[i]
+        if ch in "{[":
+            scan = next((scan for scan in scans if not scan.in_string), None)
+            if scan is None:
+                # inside a string for every scan so far, a scan from here sees a new value
+                scan = _BracketScan()
+                scans.append(scan)
+            scan.open.setdefault(scan.depth, []).append(i)
+            scan.depth += 1
+            continue
+        for scan in scans:
+            if scan.in_string:
+                if i == scan.escaped_at:
+                    continue
+                if ch == "\\":
+                    scan.escaped_at = i + 1
+                elif ch == '"':
+                    scan.in_string = False
+            elif ch == '"':
+                scan.in_string = True
+            elif ch in "}]":
+                scan.depth -= 1
+                for start in scan.open.pop(scan.depth, ()):
+                    ends[start] = i + 1
+        if len(scans) > 1 or (scans and not scans[0].open):
+            merged: dict[tuple[bool, bool], _BracketScan] = {}
+            for scan in scans:
+                # a scan without open brackets has nothing left to find
+                if scan.open:
+                    key = (scan.in_string, scan.escaped_at > i)
+                    merged[key] = merged[key].merge(scan) if key in merged else scan
+            scans = list(merged.values())
+    return ends
+
+
+def _is_tool_call(value: Any, tool_names: Container[str] | None = None) -> bool:
+    calls = value if isinstance(value, list) and value else [value]
+    return all(
+        isinstance(call, dict)
+        and isinstance(call.get("tool"), str)
+        and (tool_names is None or call["tool"] in tool_names)
+        # the arguments are filled in by name, anything but an object cannot be run
+        and isinstance(call.get("arguments") or {}, dict)
+        for call in calls
+    )
+
+
+def _parses_to_tool_call(text: str, tool_names: Container[str] | None = None) -> bool:
+    try:
+        value = json.loads(text)
+    except ValueError:
+        return False
+    return _is_tool_call(value, tool_names)
+
+
+def extract_tool_call(text: str, tool_names: Container[str]) -> dict[str, Any] | list[dict[str, Any]] | None:
+    """find the tool call object (or array of them) in an llm response
+
+    a response that is nothing but a tool call is accepted whatever the tool name, so the
+    llm is told when it calls a tool that does not exist. otherwise the first balanced json
+    value in the text naming only known tools is taken, which covers ```json fences and
+    prose around the json. a stray bracket that never closes is skipped. the text is
+    scanned once, and every candidate is parsed once.
+    """
+    stripped = text.strip()
+    if stripped[:1] in ("{", "["):
         try:
-            response = client.chat.completions.create(**payload)
-            return response.choices[0].message.content
-        except Exception as e:
-            error_message = f"Error getting LLM response: {str(e)}"
-            logging.error(error_message)
-            return error_message
+            value = json.loads(stripped)
+        except ValueError:
+            pass
+        else:
+            return value if _is_tool_call(value) else None
+    if '"tool"' not in text:
+        return None
+    position = 0
+    for start, end in sorted(_json_value_ends(text).items()):
+        # a value nested in one already tried is not a tool call of the response
+        if start < position:
+            continue
+        # brackets in prose are common, only parse values that can hold a tool call
+        if text.find('"tool"', start, end) >= 0:
+            try:
+                value = json.loads(text[start:end])
+            except ValueError:
+                value = None
+            if value is not None and _is_tool_call(value, tool_names):
+                return value
+        position = end
+    return None
+
+class ToolManifestCache:
+    """persist the tool manifest of each server, keyed by server config hash and server version"""
+    def __init__(self, path: Union[str, Path]):
+        self.path: Path = Path(path)
+        self._entries: dict[str, dict[str, Any]] | None = None
+
+    def _load(self) -> dict[str, dict[str, Any]]:
+        if self._entries is None:
+            try:
+                self._entries = json.loads(self.path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                self._entries = {}
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable tool manifest cache {self.path}: {e}")
+                self._entries = {}
+        return self._entries
+
+    def get(self, server: Server) -> list[Tool] | None:
+        """return the cached tools of a server whose config did not change"""
+        entry = self._load().get(server.name)
+        if not entry or entry.get("config_hash") != server.config_hash:
+            return None
+        # once connected, a different server version invalidates the manifest too
+        if server.version is not None and entry.get("server_version") != server.version:
+            return None
+        return [Tool.from_dict(tool) for tool in entry.get("tools", [])]
+
+    def put(self, server: Server, tools: list[Tool]) -> bool:
+        """store the manifest of a connected server, return whether it changed"""
+        entries = self._load()
+        entry = {
+            "config_hash": server.config_hash,
+            "server_version": server.version,
+            "tools": [tool.to_dict() for tool in tools],
+        }
+        if entries.get(server.name) == entry:
+            return False
+        entries[server.name] = entry
+        return True
+
+    def save(self) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            tmp_path.write_text(json.dumps(self._load(), ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Failed to write tool manifest cache {self.path}: {e}")
 
 class ChatSession:
     """orchestrate chat sessions between user and llm and tools"""
     # placeholder for file bytes and file base64 in tool call arguments
     PLACEHOLDER_FILE_BYTES = "<<file_bytes>>"
     PLACEHOLDER_FILE_BASE64 = "<<file_base64>>"
+    # prefix of the message feeding tool results back to the llm
+    TOOL_RESULT_PREFIX = "tool执行结果:\n"
+    # answer of a turn stopped by max_tool_rounds
+    TOOL_ROUNDS_EXCEEDED = "已停止: 已达到 {rounds} 轮工具调用的上限, 最后请求的工具调用没有执行"
 
     # system prompt template
     # this prompt does not require the llm has the capability of tool calling, feel free to use all kind of models
     SYSTEM_PROMPT_TEMPLATE = (
                     "你是一个智能的助手，可以使用以下工具：\n\n"
                     "{tools_description}\n\n"
-                    "请根据用户的问题选择合适的工具, 每次最多只能输出一个工具, 请严格按照上面工具描述中的参数要求来填写参数"
+                    "请根据用户的问题选择合适的工具, 请严格按照上面工具描述中的参数要求来填写参数"
                     "如果不需要使用工具，请直接回答。\n\n"
                     "注意：当你需要使用工具时，你必须只响应以下JSON对象格式，不要添加其他内容：\n"
                     "{{\n"
@@ -261,6 +1072,9 @@ class ChatSession:
                     '        "argument-name": "value"\n'
                     "    }}\n"
                     "}}\n\n"
+                    "如果需要同时调用多个互不依赖的工具，请只响应由上述JSON对象组成的JSON数组，"
+                    "这些工具会被并行执行，所有结果会在同一条消息中返回；"
+                    "如果后一个工具依赖前一个工具的结果，请分多次调用。\n\n"
                     "当收到工具的执行结果时：\n"
                     "1. 将原始数据转换为自然、流畅的对话式回答\n"
                     "2. 保持回答简洁但信息丰富\n"
@@ -269,14 +1083,65 @@ class ChatSession:
                     "5. 避免简单重复原始数据\n\n"
                     "请只使用上面明确提供的工具，不要编造工具"
                 )
-    def __init__(self, llm_client: LLMClient, servers: list[Server]):
+    # how to resolve a tool name exposed by several servers
+    TOOL_CONFLICT_PRIORITY = "priority"  # keep the tool of the server with the highest priority
+    TOOL_CONFLICT_NAMESPACE = "namespace"  # expose each duplicate as "<server>.<tool>"
+    DEFAULT_MANIFEST_CACHE = ".tool_manifest_cache.json"
+
+    def __init__(
+        self,
+        llm_client: LLMClient,
+        servers: list[Server],
+        tool_conflict: str = TOOL_CONFLICT_PRIORITY,
+        manifest_cache: ToolManifestCache | None = None,
+        max_parallel_tools: int = 4,
+        context_window: ConversationWindow | None = None,
+        result_processor: ToolResultProcessor | None = None,
+        media_store: MediaStore | None = None,
+    ):
+        if tool_conflict not in (self.TOOL_CONFLICT_PRIORITY, self.TOOL_CONFLICT_NAMESPACE):
+            raise ValueError(f"Unknown tool conflict resolution: {tool_conflict}")
         self.llm_client: LLMClient = llm_client
         self.servers: list[Server] = servers
+        self.tool_conflict: str = tool_conflict
+        self.manifest_cache: ToolManifestCache | None = manifest_cache
+        # cap of concurrent tool calls when the llm asks for several tools at once
+        self.max_parallel_tools: int = max_parallel_tools
+        # keeps the prompt under a token budget, older messages are folded into a summary
+        self.context_window: ConversationWindow = context_window or ConversationWindow()
+        if self.context_window.summarize is None:
+            self.context_window.summarize = self._summarize
+        # truncates oversized tool results, the llm pages through them with read_tool_result
+        self.result_processor: ToolResultProcessor = result_processor or ToolResultProcessor()
+        # image and binary tool results are written here by content hash
+        self.media_store: MediaStore = media_store or MediaStore()
+        self._result_pager: Tool = Tool(
+            READ_RESULT_TOOL, "分页读取因过大而被截断的工具结果的完整内容", READ_RESULT_TOOL_SCHEMA
+        )
+        # startup of each server, tool calls wait for the server they are routed to
+        self._server_starts: dict[str, asyncio.Task] = {}
+        self._revalidate_task: asyncio.Task | None = None
+        for server in servers:
+            server.on_tools_changed = self._on_tools_changed
         
         self.history: list[dict] = []
         self.message: list[dict] = []
         self.system_prompt: str = ""
         self.tools: dict[str, list[Tool]] = {}
+        # exposed tool name -> (server, tool), rebuilt by refresh_tools
+        self.tool_index: dict[str, tuple[Server, Tool]] = {}
+        # fingerprint of the exposed tool set and the system prompt rendered for it
+        self.tools_fingerprint: str = ""
+        self._prompt_cache: tuple[str, str] | None = None
+        # set by a tools/list_changed notification, tools are refreshed on the next reset
+        self._tools_stale: bool = False
+        # servers skipped at startup, name -> reason
+        self.failed_servers: dict[str, str] = {}
+        # called with (server name, reason) when a server is skipped, also for startups
+        # finished in the background after a prompt was built from the manifest cache
+        self.on_server_failed: Callable[[str, str], None] | None = None
+        # session this one was forked from, owner of the shared servers
+        self._parent: ChatSession | None = None
 
         self.attached_file: bytes = None
 
@@ -293,50 +1158,231 @@ class ChatSession:
             api_key=config.api_key,
             base_url=config.base_url,
             model=config.model_id,
+            timeout=config.timeout,
+            max_connections=config.max_connections,
+            max_keepalive_connections=config.max_keepalive_connections,
+        )
+        # tool manifests are cached next to the config file unless toolManifestCache is null
+        cache_path = servers_config.get("toolManifestCache", cls.DEFAULT_MANIFEST_CACHE)
+        if cache_path is not None:
+            cache_path = Path(config_file).parent / cache_path
+        # "tracing": {"jsonl": "<path>", "chrome": "<path>"}, spans are not exported without it
+        tracer.configure(**servers_config.get("tracing", {}))
+        return cls(
+            llm_client,
+            serves,
+            tool_conflict=servers_config.get("toolConflict", cls.TOOL_CONFLICT_PRIORITY),
+            manifest_cache=ToolManifestCache(cache_path) if cache_path is not None else None,
+            max_parallel_tools=servers_config.get("maxParallelTools", 4),
+            # "contextWindow": {"max_tokens", "keep_recent"}
+            context_window=ConversationWindow(**servers_config.get("contextWindow", {})),
+            # "toolResultLimits": {"max_bytes", "max_tokens", "spill_dir", "max_spill_bytes", "max_spill_age",
+            #                      "tools": {"<tool>": {...}}}
+            result_processor=ToolResultProcessor(**servers_config.get("toolResultLimits", {})),
+            # "mediaOutput": {"output_dir", "max_bytes"}
+            media_store=MediaStore(**servers_config.get("mediaOutput", {})),
         )
-        return cls(llm_client, serves)
     
+    async def _list_server_tools(self, server: Server) -> tuple[list[Tool] | None, bool]:
+        """tools of a server, or None when it fails to answer
+
+        Returns:
+            (tools, whether they were served from the manifest cache)
+        """
+        if server.lazy and not server.is_running:
+            # describe a stopped lazy server from its manifest instead of spawning it
+            cached = self.manifest_cache.get(server) if self.manifest_cache else None
+            if cached is not None:
+                return cached, True
+            try:
+                await server.ensure_started()
+            except Exception as e:
+                logging.error(f"Failed to start server {server.name}: {e}, skipped")
+                return None, False
+        try:
+            return await asyncio.wait_for(server.list_tools(), timeout=server.startup_timeout), False
+        except asyncio.TimeoutError:
+            logging.error(f"Listing tools of server {server.name} timed out after {server.startup_timeout}s, skipped")
+        except Exception as e:
+            logging.error(f"Failed to list tools of server {server.name}: {e}, skipped")
+        return None, False
+
     async def refresh_tools(self):
-        self.tools = {}
+        """list tools of all servers concurrently, servers failing to answer are left out"""
+        results = await asyncio.gather(*(self._list_server_tools(server) for server in self.servers))
+        tools = {
+            server.name: server_tools
+            for server, (server_tools, _) in zip(self.servers, results)
+            if server_tools is not None
+        }
+        if self.manifest_cache:
+            # a manifest read from the cache has no server version to store, it is left as is
+            changed = [
+                self.manifest_cache.put(server, server_tools)
+                for server, (server_tools, from_cache) in zip(self.servers, results)
+                if server_tools is not None and not from_cache
+            ]
+            if any(changed):
+                self.manifest_cache.save()
+        self._set_tools(tools)
+
+    def _set_tools(self, tools: dict[str, list[Tool]]) -> None:
+        tool_index = self._build_tool_index(tools)
+        # swap both at once so execute_tool never sees a half built index
+        self.tools, self.tool_index = tools, tool_index
+        self.tools_fingerprint = self._fingerprint_tools(tool_index)
+        self._tools_stale = False
+
+    @staticmethod
+    def _fingerprint_tools(tool_index: dict[str, tuple[Server, Tool]]) -> str:
+        digest = hashlib.sha256()
+        for name, (_, tool) in tool_index.items():
+            digest.update(json.dumps([name, tool.description, tool.function], sort_keys=True, default=str).encode("utf-8"))
+        return digest.hexdigest()
+
+    def cache_stats(self) -> dict[str, dict[str, dict[str, int]]]:
+        """result cache counters, server name -> tool name -> stats"""
+        return {server.name: server.cache_stats() for server in self.servers if server.result_caches}
+
+    def _on_tools_changed(self, server: Server) -> None:
+        self._tools_stale = True
+
+    def _build_tool_index(self, tools: dict[str, list[Tool]]) -> dict[str, tuple[Server, Tool]]:
+        """map every exposed tool name to the server and tool handling it"""
+        candidates: dict[str, list[tuple[Server, Tool]]] = {}
         for server in self.servers:
-            tools = await server.list_tools()
-            self.tools[server.name] = tools
+            for tool in tools.get(server.name, []):
+                candidates.setdefault(tool.name, []).append((server, tool))
+
+        index: dict[str, tuple[Server, Tool]] = {}
+        for name, entries in candidates.items():
+            if len(entries) == 1:
+                index[name] = entries[0]
+                continue
+            owners = [server.name for server, _ in entries]
+            if self.tool_conflict == self.TOOL_CONFLICT_NAMESPACE:
+                logging.warning(f"Tool {name} is provided by {owners}, exposed with server namespace")
+                for server, tool in entries:
+                    index[f"{server.name}.{name}"] = (server, tool)
+            else:
+                # max keeps the first server in config order on equal priority
+                winner = max(entries, key=lambda entry: entry[0].priority)
+                logging.warning(f"Tool {name} is provided by {owners}, using the one of {winner[0].name}")
+                index[name] = winner
+        return index
     
     async def reset_session(self):
-        """reset session history and messages
-        Args:
-            attach_file: file bytes to be attached to the session
-        """
+        """reset session history and messages"""
         self.history = []
         self.messages = []
-        # format tools description
-        descriptions = []
-        for server in self.servers:
-            for tool in self.tools[server.name]:
-                descriptions.append(tool.format_tool())
-        tools_description = "\n".join(descriptions)
-        # construct system message
-        system_message = self.SYSTEM_PROMPT_TEMPLATE.format(tools_description=tools_description)
-        # print(system_message)
-        self.messages = [{"role": "system", "content": system_message}]
+        await self.refresh_system_prompt()
+
+    async def refresh_system_prompt(self):
+        """pick up tool changes and update the system message, the conversation is kept"""
+        if self._parent is not None:
+            await self._sync_with_parent()
+        elif self._tools_stale:
+            await self.refresh_tools()
+        system_message = {"role": "system", "content": self.render_system_prompt()}
+        if self.messages and self.messages[0]["role"] == "system":
+            self.messages[0] = system_message
+        else:
+            self.messages.insert(0, system_message)
     
+    def render_system_prompt(self) -> str:
+        """render the system prompt, memoized by the fingerprint of the tool set"""
+        if self._prompt_cache and self._prompt_cache[0] == self.tools_fingerprint:
+            return self._prompt_cache[1]
+        with tracer.span("prompt.render", tools=len(self.tool_index)):
+            # format tools description
+            descriptions = [tool.format_tool(name) for name, (_, tool) in self.tool_index.items()]
+            descriptions.append(self._result_pager.format_tool())
+            tools_description = "\n".join(descriptions)
+            # construct system message
+            system_message = self.SYSTEM_PROMPT_TEMPLATE.format(tools_description=tools_description)
+        self._prompt_cache = (self.tools_fingerprint, system_message)
+        return system_message
+
+    async def _start_server(self, server: Server) -> bool:
+        try:
+            await asyncio.wait_for(server.initialize(), timeout=server.startup_timeout)
+            return True
+        except asyncio.TimeoutError:
+            reason = f"not ready within {server.startup_timeout}s"
+        except Exception as e:
+            reason = str(e)
+        logging.error(f"Server {server.name} skipped: {reason}")
+        self.failed_servers[server.name] = reason
+        if self.on_server_failed:
+            self.on_server_failed(server.name, reason)
+        await server.cleanup()
+        return False
+
     async def start_session(self):
         """start a new session
+
+        servers are initialized concurrently, a server that fails or exceeds its
+        startup_timeout is recorded in failed_servers, reported to on_server_failed and skipped.
+        when every server has a cached tool manifest, the first prompt is built from the
+        cache and the servers are started and revalidated in the background. lazy servers
+        with a cached manifest are not started at all until one of their tools is called.
         """
+        self._server_starts = {
+            server.name: asyncio.create_task(self._start_server(server))
+            for server in self.servers
+            if not (server.lazy and self.manifest_cache and self.manifest_cache.get(server) is not None)
+        }
+        cached = self._cached_tools() if not self.tools else None
+        if cached is not None:
+            self._set_tools(cached)
+            self._revalidate_task = asyncio.create_task(self._revalidate_tools())
+        else:
+            await self._finish_startup()
+        await self.reset_session()
+
+    def _cached_tools(self) -> dict[str, list[Tool]] | None:
+        if not self.manifest_cache:
+            return None
+        tools = {}
         for server in self.servers:
-            await server.initialize()
+            server_tools = self.manifest_cache.get(server)
+            if server_tools is None:
+                return None
+            tools[server.name] = server_tools
+        return tools
+
+    async def _finish_startup(self) -> None:
+        started = await asyncio.gather(*self._server_starts.values())
+        failed = {name for name, ok in zip(self._server_starts, started) if not ok}
+        self.servers = [server for server in self.servers if server.name not in failed]
         # refresh tools if not initialized
         if not self.tools:
             await self.refresh_tools()
-        await self.reset_session()
-    
+
+    async def _revalidate_tools(self) -> None:
+        """start the servers behind a cached manifest and refresh it, the prompt is only rebuilt if tools changed"""
+        try:
+            await self._finish_startup()
+            await self.refresh_tools()
+        except Exception as e:
+            logging.error(f"Failed to revalidate cached tools: {e}")
+
     async def close_session(self):
         """close session
         """
-        for server in self.servers:
-            await server.cleanup()
         self.history.extend(self.messages)
         self.messages = []
+        if self._parent is not None:
+            # servers and stores belong to the session this one was forked from
+            return
+        if self._revalidate_task:
+            self._revalidate_task.cancel()
+            await asyncio.gather(self._revalidate_task, return_exceptions=True)
+            self._revalidate_task = None
+        for server in self.servers:
+            await server.cleanup()
+        await asyncio.to_thread(self.media_store.close)
+        tracer.shutdown()
 
     async def cleanup_servers(self) -> None:
         """Clean up all servers properly."""
@@ -351,49 +1397,304 @@ class ChatSession:
                 logging.warning(f"Warning during final cleanup: {e}")
 
     async def execute_tool(self, tool_name: str, args: dict[str, Any]) -> Any:
-        for server in self.servers:
-            if tool_name in [tool.name for tool in self.tools[server.name]]:
-                res = await server.excute_tool(tool_name, args)
-                if isinstance(res, dict) and "progress" in res:
-                    percentage = res["progress"] / res["total"] * 100
-                    logging.info(f"Tool {tool_name} is a progress tool, returning progress: {percentage:.2f}")
-                return res
-        raise ValueError(f"Tool {tool_name} not found on any server.")
+        if tool_name == READ_RESULT_TOOL and tool_name not in self.tool_index:
+            try:
+                page = self.result_processor.read(**args)
+            except TypeError as e:
+                page = f"Invalid arguments for {READ_RESULT_TOOL}: {e}"
+            return CallToolResult(content=[TextContent(type="text", text=page)])
+        entry = self.tool_index.get(tool_name)
+        if entry is None:
+            raise ToolNotFoundError(tool_name)
+        server, tool = entry
+        start = self._server_starts.get(server.name)
+        if start is not None and not start.done():
+            # the prompt was built from the manifest cache, wait for this server only
+            await asyncio.shield(start)
+        res = await server.excute_tool(tool.name, args)
+        if isinstance(res, dict) and "progress" in res:
+            percentage = res["progress"] / res["total"] * 100
+            logging.info(f"Tool {tool_name} is a progress tool, returning progress: {percentage:.2f}")
+        with tracer.span("tool_result.process", tool=tool_name) as span:
+            processed = self.result_processor.process(tool.name, res)
+            span.set(truncated=processed is not res)
+        return processed
     
-    async def process_llm_response(self, response: str, refresh_tools: bool = False, file_bytes: bytes = None):
-        if refresh_tools:
-            await self.refresh_tools()
+    def fork(self) -> "ChatSession":
+        """a new conversation sharing servers, tools, llm client and stores with this session
+
+        the fork has its own messages, history and context window; it never starts or
+        cleans up the shared servers, and picks up tool changes of this session on reset.
+        """
+        conversation = copy.copy(self)
+        conversation._parent = self
+        conversation.history = []
+        conversation.messages = []
+        conversation.failed_servers = {}
+        conversation.context_window = ConversationWindow(
+            max_tokens=self.context_window.max_tokens, keep_recent=self.context_window.keep_recent
+        )
+        conversation.context_window.summarize = conversation._summarize
+        return conversation
+
+    async def _sync_with_parent(self) -> None:
+        parent = self._parent
+        if parent._tools_stale:
+            await parent.refresh_tools()
+        self.servers = parent.servers
+        self.tools, self.tool_index = parent.tools, parent.tool_index
+        self.tools_fingerprint, self._prompt_cache = parent.tools_fingerprint, parent._prompt_cache
+
+    @staticmethod
+    def is_tool_result(result: Any) -> bool:
+        """a single tool result, or a list of (tool name, result) for parallel tool calls"""
+        return isinstance(result, (CallToolResult, list))
+
+    async def collect_tool_result(self, result: Any) -> list[str]:
+        """turn a tool result into text for the llm, images and binary resources are saved to files"""
+        if not isinstance(result, CallToolResult):
+            # error message of a failed tool call
+            return [str(result)]
+        tool_results = []
+        for item in result.content:
+            if item.type == "image":
+                file_name = await self.media_store.save(item.data, item.mimeType)
+                logging.info(f"Image is saved to {file_name}")
+                tool_results.append(f"图片已保存到 {file_name}")
+            elif item.type == "resource" and getattr(item.resource, "blob", None):
+                file_name = await self.media_store.save(item.resource.blob, item.resource.mimeType, kind="blob")
+                logging.info(f"File is saved to {file_name}")
+                tool_results.append(f"文件已保存到 {file_name}")
+            elif item.type == "text":
+                tool_results.append(item.text)
+        return tool_results
+
+    async def format_tool_results(self, result: Any) -> str:
+        """text of one tool result, or of several results merged into one message"""
+        if not isinstance(result, list):
+            return "\n".join(await self.collect_tool_result(result))
+        collected = await asyncio.gather(*(self.collect_tool_result(tool_result) for _, tool_result in result))
+        tool_results = []
+        for (tool_name, _), texts in zip(result, collected):
+            tool_results.append(f"[{tool_name}]")
+            tool_results.extend(texts)
+        return "\n".join(tool_results)
+
+    async def run_turn(
+        self,
+        user_prompt: str,
+        attachment: Attachment | None = None,
+        on_token: Callable[[str], None] | None = None,
+        on_tool_results: Callable[[str], None] | None = None,
+        max_tool_rounds: int | None = None,
+    ) -> str:
+        """answer one user message, running tool calls until the llm gives a final answer
+
+        Args:
+            on_token: stream the answer to this callback, see stream_llm_response
+            on_tool_results: called with the text of every tool round fed back to the llm
+            max_tool_rounds: stop after this many tool rounds, unlimited by default. a tool call
+                requested after the last round is not run, the turn ends with TOOL_ROUNDS_EXCEEDED
+
+        Returns:
+            the last llm response
+        """
+        self.context_window.prompt_tokens = []
+        self.messages.append({"role": "user", "content": user_prompt})
+        rounds = 0
+        with tracer.span("chat.turn", stream=on_token is not None) as span:
+            while True:
+                span.set(tool_rounds=rounds)
+                if on_token:
+                    response = await self.stream_llm_response(on_token)
+                else:
+                    response = await self.get_response()
+                if max_tool_rounds is not None and rounds >= max_tool_rounds and extract_tool_call(
+                    response, self.tool_index.keys() | {READ_RESULT_TOOL}
+                ) is not None:
+                    # the tool call over the limit is not run, the notice takes its place in the history
+                    logging.warning(f"Stopped after {rounds} tool rounds")
+                    response = self.TOOL_ROUNDS_EXCEEDED.format(rounds=rounds)
+                    self.messages.append({"role": "assistant", "content": response})
+                    if on_token:
+                        on_token(response)
+                    return response
+                self.messages.append({"role": "assistant", "content": response})
+                result = await self.process_llm_response(response, attachment=attachment)
+                if not self.is_tool_result(result):
+                    return response
+                rounds += 1
+                with tracer.span("tool_result.format", results=len(result) if isinstance(result, list) else 1):
+                    tool_results = await self.format_tool_results(result)
+                if on_tool_results:
+                    on_tool_results(tool_results)
+                # 将工具调用结果添加到对话历史
+                self.messages.append({"role": "user", "content": self.TOOL_RESULT_PREFIX + tool_results})
+
+    SUMMARY_PROMPT = (
+        "请将下面的对话内容压缩成简洁的摘要，保留用户的目标、已经调用过的工具及其关键结果、"
+        "以及尚未完成的事项，不要编造内容：\n\n{conversation}"
+    )
+
+    async def _summarize(self, messages: list[dict[str, Any]]) -> str:
+        conversation = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        return await self.llm_client.complete(
+            [{"role": "user", "content": self.SUMMARY_PROMPT.format(conversation=conversation)}]
+        )
+
+    @property
+    def turn_prompt_tokens(self) -> list[int]:
+        """prompt token count of every llm request of the current turn"""
+        return self.context_window.prompt_tokens
+
+    async def fit_context(self) -> None:
+        """fold older messages into a summary when the prompt is over the token budget"""
+        self.messages = await self.context_window.fit(self.messages)
+
+    async def get_response(self) -> str:
+        """get the next llm response for the current messages"""
+        await self.fit_context()
+        return await self.llm_client.get_response(self.messages)
+
+    async def stream_llm_response(self, on_token: Callable[[str], None]) -> str:
+        """stream the llm answer to on_token as it is generated
+
+        a response starting like a tool call ('{"' or '[{') is held back until the json value is complete.
+        when it is a tool call the stream is closed right there, so the tools can be
+        dispatched without waiting for the tail of the completion; otherwise (e.g. "[注意] ...")
+        the held text is emitted and the rest is streamed as prose. in prose, a ```json block
+        is held back the same way, see FencedToolCallFilter. a tool call written into the
+        prose without a fence is streamed as text and run once the answer is complete.
+
+        Returns:
+            the full answer, or the answer up to the end of the tool call json
+        """
+        await self.fit_context()
+        tool_names = self.tool_index.keys() | {READ_RESULT_TOOL}
+        chunks: list[str] = []
+        scanner: JsonObjectScanner | None = None
+        prose: FencedToolCallFilter | None = None
         try:
-            tool_call = json.loads(response)
-            if tool_call.get("tool"):
-                tool_name = tool_call["tool"]
-                args = tool_call["arguments"]
-                logging.info(f"Executing tool {tool_name} with arguments {args}")
-                for key, value in tool_call["arguments"].items():
-                    if value == self.PLACEHOLDER_FILE_BYTES:
-                        if file_bytes:
-                            args[key] = file_bytes
-                        else:
-                            logging.error("No file bytes provided")
-                            return "No file provided"
-                    elif value == self.PLACEHOLDER_FILE_BASE64:
-                        if file_bytes:
-                            args[key] = base64.b64encode(file_bytes)
+            async with aclosing(self.llm_client.stream_response(self.messages)) as stream:
+                async for delta in stream:
+                    if scanner is None and prose is None:
+                        # decide on the first non blank character
+                        chunks.append(delta)
+                        head = "".join(chunks).lstrip()
+                        if not head or (head[0] in "{[" and not head[1:].strip()):
+                            continue
+                        chunks, delta = [], head
+                        if _TOOL_CALL_START.match(head):
+                            scanner = JsonObjectScanner()
                         else:
-                            logging.error("No file provided")
-                            return "No file provided"
-                try:
-                    result = await self.execute_tool(tool_name, args)
-                    logging.info(f"Tool execution result: {result}")
-                    return result
-                except ToolNotFoundError as e:
-                    logging.error(f"Tool {tool_call['tool']} not found")
-                    return f"Tool {tool_call['tool']} not found"
-                except Exception as e:
-                    error_msg = f"Error executing tool: {str(e)}"
-                    logging.error(error_msg)
-                    return error_msg
-            return response
-        except json.JSONDecodeError:
+                            prose = FencedToolCallFilter(on_token, tool_names)
+                    if scanner is not None:
+                        end = scanner.feed(delta)
+                        if end < 0:
+                            chunks.append(delta)
+                            continue
+                        chunks.append(delta[:end])
+                        if _parses_to_tool_call("".join(chunks)):
+                            return "".join(chunks)
+                        on_token("".join(chunks))
+                        scanner, prose, delta = None, FencedToolCallFilter(on_token, tool_names), delta[end:]
+                    end = prose.feed(delta)
+                    if end >= 0:
+                        chunks.append(delta[:end])
+                        return "".join(chunks)
+                    chunks.append(delta)
+        except Exception as e:
+            error_message = f"Error getting LLM response: {str(e)}"
+            logging.error(error_message)
+            return error_message
+        response = "".join(chunks)
+        if prose is not None:
+            prose.flush()
+        elif response.strip() and extract_tool_call(response, tool_names) is None:
+            # the bracket never closed, the held text was an answer after all
+            on_token(response)
+        return response
+
+    def _fill_placeholders(self, args: dict[str, Any], file: Attachment | bytes | None) -> dict[str, Any]:
+        """replace file placeholders in tool call arguments
+
+        an Attachment reuses its cached content and base64 encoding instead of encoding per call.
+
+        Raises:
+            ValueError: a placeholder is used but no file is attached.
+        """
+        for key, value in args.items():
+            if value == self.PLACEHOLDER_FILE_BYTES:
+                if not file:
+                    logging.error("No file bytes provided")
+                    raise ValueError("No file provided")
+                args[key] = file.raw if isinstance(file, Attachment) else file
+            elif value == self.PLACEHOLDER_FILE_BASE64:
+                if not file:
+                    logging.error("No file provided")
+                    raise ValueError("No file provided")
+                args[key] = file.base64 if isinstance(file, Attachment) else base64.b64encode(file).decode("ascii")
+        return args
+
+    async def _run_tool_call(self, tool_call: dict[str, Any], file: Attachment | bytes | None) -> Any:
+        """execute one parsed tool call, errors are returned as a message string"""
+        tool_name = tool_call["tool"]
+        try:
+            args = self._fill_placeholders(tool_call.get("arguments") or {}, file)
+        except ValueError as e:
+            return str(e)
+        logging.info(f"Executing tool {tool_name} with arguments {args}")
+        try:
+            result = await self.execute_tool(tool_name, args)
+            logging.info(f"Tool execution result: {result}")
+            return result
+        except ToolNotFoundError as e:
+            logging.error(f"Tool {tool_name} not found")
+            return f"Tool {tool_name} not found"
+        except Exception as e:
+            error_msg = f"Error executing tool: {str(e)}"
+            logging.error(error_msg)
+            return error_msg
+
+    async def execute_tool_calls(
+        self, tool_calls: list[dict[str, Any]], file: Attachment | bytes | None = None
+    ) -> list[tuple[str, Any]]:
+        """run independent tool calls concurrently, at most max_parallel_tools at a time
+
+        Returns:
+            (tool name, result or error message) in the order of tool_calls
+        """
+        semaphore = asyncio.Semaphore(self.max_parallel_tools)
+
+        async def run(tool_call: dict[str, Any]) -> Any:
+            async with semaphore:
+                return await self._run_tool_call(tool_call, file)
+
+        results = await asyncio.gather(*(run(tool_call) for tool_call in tool_calls))
+        return [(tool_call["tool"], result) for tool_call, result in zip(tool_calls, results)]
+
+    async def process_llm_response(
+        self,
+        response: str,
+        refresh_tools: bool = False,
+        file_bytes: bytes = None,
+        attachment: Attachment | None = None,
+    ):
+        """execute the tool call(s) in an llm response
+
+        Returns:
+            the tool result for a single tool call object, a list of (tool name, result)
+            for a json array of tool calls, or the response itself when it is not a tool call
+        """
+        if refresh_tools:
+            await self.refresh_tools()
+        with tracer.span("tool_call.parse", chars=len(response)) as span:
+            tool_call = extract_tool_call(response, self.tool_index.keys() | {READ_RESULT_TOOL})
+            span.set(calls=len(tool_call) if isinstance(tool_call, list) else int(tool_call is not None))
+        if tool_call is None:
             # if not tool call, return the original response
-            return response
\ No newline at end of file
+            return response
+        file = attachment or file_bytes
+        if isinstance(tool_call, dict):
+            return await self._run_tool_call(tool_call, file)
+        return await self.execute_tool_calls(tool_call, file)
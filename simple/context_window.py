@@ -0,0 +1,112 @@
+"""
+@Desc : token budgeted conversation window with rolling summaries
+"""
+import hashlib
+import json
+import logging
+from functools import lru_cache
+from typing import Any, Awaitable, Callable
+
+try:
+    import tiktoken
+except ImportError:  # fall back to an estimate when tiktoken is not installed
+    tiktoken = None
+
+# tokens added by the chat format around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_PREFIX = "之前对话的摘要:\n"
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # the encoding is downloaded on first use, offline hosts fall back to the estimate
+        logging.warning(f"Failed to load the cl100k_base encoding, token counts are estimated: {e}")
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_text_tokens(text: str) -> int:
+    """count tokens of a text, CJK characters are counted one token each without tiktoken"""
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    cjk = sum(1 for ch in text if "\u2e80" <= ch <= "\u9fff" or "\uac00" <= ch <= "\ud7af")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(messages: list[dict[str, Any]]) -> int:
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False, default=str)
+        total += count_text_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    return total
+
+
+class ConversationWindow:
+    """keep the messages sent to the llm under a token budget
+
+    the system prompt and the most recent messages are kept verbatim, older messages are
+    folded into a summary message. a later fold summarizes the previous summary together
+    with the newly folded messages, so the summary rolls forward with the conversation.
+    """
+    def __init__(
+        self,
+        max_tokens: int = 16000,
+        keep_recent: int = 6,
+        summarize: Callable[[list[dict[str, Any]]], Awaitable[str]] | None = None,
+        max_summaries: int = 64,
+    ):
+        self.max_tokens: int = max_tokens
+        self.keep_recent: int = keep_recent
+        self.summarize = summarize
+        # hash of folded messages -> summary
+        self._summaries: dict[str, str] = {}
+        self.max_summaries: int = max_summaries
+        self.prompt_tokens: list[int] = []
+
+    @staticmethod
+    def _fold_key(messages: list[dict[str, Any]]) -> str:
+        payload = json.dumps([[m.get("role"), m.get("content")] for m in messages], ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def _summary(self, messages: list[dict[str, Any]]) -> str | None:
+        key = self._fold_key(messages)
+        if key in self._summaries:
+            return self._summaries[key]
+        if self.summarize is None:
+            return None
+        try:
+            summary = await self.summarize(messages)
+        except Exception as e:
+            logging.warning(f"Failed to summarize conversation, dropping older messages: {e}")
+            return None
+        if len(self._summaries) >= self.max_summaries:
+            self._summaries.pop(next(iter(self._summaries)))
+        self._summaries[key] = summary
+        return summary
+
+    async def fit(self, messages: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """return messages within the budget, the first message is treated as the system prompt"""
+        tokens = count_message_tokens(messages)
+        if tokens > self.max_tokens and len(messages) > self.keep_recent + 2:
+            system, older, recent = messages[0], messages[1:-self.keep_recent], messages[-self.keep_recent:]
+            summary = await self._summary(older)
+            folded = [system]
+            if summary:
+                folded.append({"role": "user", "content": SUMMARY_PREFIX + summary})
+            folded.extend(recent)
+            logging.info(f"Folded {len(older)} messages, prompt tokens {tokens} -> {count_message_tokens(folded)}")
+            messages = folded
+            tokens = count_message_tokens(messages)
+            if tokens > self.max_tokens:
+                logging.warning(f"Prompt still has {tokens} tokens, over the budget of {self.max_tokens}")
+        self.prompt_tokens.append(tokens)
+        logging.info(f"Prompt tokens: {tokens}")
+        return messages
@@ -1,51 +1,370 @@
 from mcp.server.fastmcp import FastMCP
+import base64
+import json
+import logging
 import os
 import pathlib
+import re
+import shutil
+import tempfile
+from collections import OrderedDict
+
+from search_index import SearchIndex
 
 mcp = FastMCP(name="file_server")
 
 # 设置允许访问的基础目录(限制在data目录下)
 BASE_DIR = pathlib.Path(__file__).parent.parent.resolve()
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB文件大小限制
+DEFAULT_CHUNK_SIZE = 8 * 1024  # 分段读取时每段的默认字节数
+# search_files建立索引的目录, 索引保存在该目录下的.search_index.json
+SEARCH_ROOT = os.getenv("BASE_DATA_DIR", "data")
+search_index = SearchIndex(SEARCH_ROOT)
+
+
+class FileContentCache:
+    """LRU cache of decoded file contents, an entry is only valid for the mtime and size it was read at"""
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes: int = max_bytes
+        # resolved path -> (mtime_ns, size, content), one version per file
+        self._entries: OrderedDict[str, tuple[int, int, str]] = OrderedDict()
+        self._bytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+
+    def get(self, path: str, stat: os.stat_result) -> str | None:
+        entry = self._entries.get(path)
+        if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size):
+            if entry is not None:
+                self._remove(path)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(path)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, path: str, stat: os.stat_result, content: str) -> None:
+        # sizes are counted in file bytes
+        if stat.st_size > self.max_bytes:
+            return
+        if path in self._entries:
+            self._remove(path)
+        self._entries[path] = (stat.st_mtime_ns, stat.st_size, content)
+        self._bytes += stat.st_size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, path: str) -> None:
+        if path in self._entries:
+            self._remove(path)
+            self.invalidations += 1
+
+    def _remove(self, path: str) -> None:
+        _, size, _ = self._entries.pop(path)
+        self._bytes -= size
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+# 文件内容缓存的总字节数上限, 设为0关闭缓存
+content_cache = FileContentCache(int(os.getenv("FILE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+
+
+def _utf8_prefix(data: bytes) -> int:
+    """length of the longest prefix of data that does not end inside a utf-8 character"""
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte & 0xC0 == 0x80:
+            continue
+        need = 1 if byte < 0x80 else 4 if byte >= 0xF0 else 3 if byte >= 0xE0 else 2
+        return len(data) - back if need > back else len(data)
+    return len(data)
+
+
+def _encode_cursor(state: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(state).encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor: str) -> dict:
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(state, dict) or not isinstance(state.get("pos"), int):
+        raise ValueError("Invalid cursor")
+    return state
+
+
+def _read_bytes(f, pos: int, length: int) -> tuple[bytes, int]:
+    """read about length bytes from pos, aligned to utf-8 characters, return (data, start)"""
+    f.seek(pos)
+    data = f.read(length)
+    # an offset inside a character starts at the next one
+    skip = 0
+    while skip < min(len(data), 3) and data[skip] & 0xC0 == 0x80:
+        skip += 1
+    data = data[skip:]
+    if len(data) == length - skip:
+        data = data[:_utf8_prefix(data)]
+    return data, pos + skip
+
+
+def _read_lines(f, pos: int, line: int, start_line: int, end_line: int | None, budget: int) -> tuple[bytes, int, int, int, int]:
+    """read whole lines from pos until end_line or the byte budget
+
+    lines before start_line are skipped without being kept, a line longer than the budget
+    is returned in parts and the line number only advances at its end.
+
+    Returns:
+        (data, byte offset of data, first line, last line in data, line to continue from)
+    """
+    f.seek(pos)
+    while line < start_line:
+        raw = f.readline(DEFAULT_CHUNK_SIZE)
+        if not raw:
+            break
+        pos += len(raw)
+        if raw.endswith(b"\n"):
+            line += 1
+    first_line = last_line = line
+    chunks, used = [], 0
+    while used < budget and (end_line is None or line <= end_line):
+        limit = budget - used
+        raw = f.readline(limit)
+        if not raw:
+            break
+        last_line = line
+        if raw.endswith(b"\n"):
+            chunks.append(raw)
+            used += len(raw)
+            line += 1
+        elif len(raw) < limit:
+            # last line of the file without a newline
+            chunks.append(raw)
+            line += 1
+            break
+        else:
+            # the line goes on past the budget, keep whole characters only
+            chunks.append(raw[:_utf8_prefix(raw)])
+            break
+    data = b"".join(chunks)
+    return data, pos, first_line, last_line if data else first_line - 1, line
 
 
 @mcp.tool()
-def read_file(file_path: str) -> str:
+def read_file(
+    file_path: str,
+    offset: int | None = None,
+    length: int | None = None,
+    start_line: int | None = None,
+    end_line: int | None = None,
+    cursor: str | None = None,
+) -> dict:
     """
-    安全读取文件内容
+    安全读取文件内容, 支持按字节范围或行范围分段读取大文件
     Args:
         file_path: 相对于项目根目录的文件路径
+        offset: 起始字节偏移, 与length一起按字节范围读取
+        length: 本次最多读取的字节数, 默认为8192
+        start_line: 起始行号(从1开始), 按行范围读取
+        end_line: 结束行号(包含), 不填则读到本段字节数上限
+        cursor: 上一次读取返回的next_cursor, 用于继续读取下一段
     Returns:
-        文件内容字符串
+        文件内容及范围信息, 未读完时next_cursor不为空
     """
     
     try:
-        file_size = os.path.getsize(file_path)
-        if file_size > MAX_FILE_SIZE:
-            return {"error": f"File size exceeds limit of {MAX_FILE_SIZE} bytes"}
-            
-        with open(file_path, 'r', encoding='utf-8') as f:
+        stat = os.stat(file_path)
+        file_size = stat.st_size
+        path = os.path.realpath(file_path)
+        if cursor:
+            state = _decode_cursor(cursor)
+            if state.get("path") != path:
+                return {"error": "Cursor belongs to another file"}
+            if state.get("mtime_ns") != stat.st_mtime_ns or state.get("size") != file_size:
+                return {"error": "File changed since the cursor was issued, read it again from the start"}
+            pos, line, end_line = state["pos"], state.get("line"), state.get("end_line")
+            start_line = line
+            length = length or state.get("length")
+        elif start_line is not None or end_line is not None:
+            pos, line = 0, 1
+            start_line = start_line or 1
+        elif offset is not None or length is not None or file_size > MAX_FILE_SIZE:
+            # files over the limit are read in chunks instead of being refused
+            pos, line = offset or 0, None
+        else:
+            content = content_cache.get(path, stat)
+            if content is None:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+                content_cache.put(path, stat, content)
             return {
-                "content": f.read(),
+                "content": content,
                 "file_size": file_size,
                 "encoding": "utf-8"
             }
+        length = min(length or DEFAULT_CHUNK_SIZE, MAX_FILE_SIZE)
+        if pos < 0 or length < 1 or (start_line is not None and start_line < 1):
+            return {"error": "offset must be >= 0, length and start_line must be >= 1"}
+
+        with open(file_path, 'rb') as f:
+            if line is None:
+                data, start = _read_bytes(f, pos, max(length, 4))
+                next_pos = start + len(data)
+                result = {"offset": start, "length": len(data)}
+                done = next_pos >= file_size
+            else:
+                data, start, first_line, last_line, next_line = _read_lines(
+                    f, pos, line, start_line, end_line, max(length, 4)
+                )
+                next_pos = start + len(data)
+                result = {"offset": start, "start_line": first_line, "end_line": last_line}
+                done = next_pos >= file_size or (end_line is not None and next_line > end_line)
+        next_cursor = None
+        if not done:
+            next_cursor = _encode_cursor({
+                "path": path,
+                "mtime_ns": stat.st_mtime_ns,
+                "size": file_size,
+                "pos": next_pos,
+                "line": next_line if line is not None else None,
+                "end_line": end_line,
+                "length": length,
+            })
+        return {
+            "content": data.decode("utf-8"),
+            "file_size": file_size,
+            "encoding": "utf-8",
+            **result,
+            "eof": next_pos >= file_size,
+            "next_cursor": next_cursor,
+        }
     except FileNotFoundError:
         return {"error": "File not found"}
     except PermissionError:
         return {"error": "Permission denied"}
     except UnicodeDecodeError:
         return {"error": "File encoding not supported"}
+    except ValueError as e:
+        return {"error": str(e)}
     except Exception as e:
         return {"error": f"Failed to read file: {str(e)}"}
 
+def _umask() -> int:
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# 原子写入时临时文件的权限, 与直接创建的文件一致
+NEW_FILE_MODE = 0o666 & ~_umask()
+MAX_BATCH_FILES = 256  # write_files一次最多写入的文件数
+
+
+def _open_for_write(file_path: str, atomic: bool, newline: str | None = None):
+    """return (file, temp path), in atomic mode the content goes to a temp file next to file_path"""
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if not atomic:
+        return open(file_path, 'w', encoding='utf-8', newline=newline), None
+    # a hidden name keeps the temp file out of the search index
+    fd, tmp_path = tempfile.mkstemp(dir=directory or ".", prefix=f".{os.path.basename(file_path)}.", suffix=".tmp")
+    try:
+        os.chmod(tmp_path, os.stat(file_path).st_mode & 0o7777 if os.path.exists(file_path) else NEW_FILE_MODE)
+        return os.fdopen(fd, 'w', encoding='utf-8', newline=newline), tmp_path
+    except BaseException:
+        os.close(fd)
+        os.remove(tmp_path)
+        raise
+
+
+def _commit_writes(pending: list[tuple[str, object, str | None]], fsync: bool) -> None:
+    """flush, optionally fsync, close and rename the files of one write
+
+    every file is synced before any rename, so a batch pays for one round of syncs instead of
+    one per file. the directories are synced afterwards by _fsync_dirs, once the files are in place.
+    """
+    _sync_writes(pending, fsync)
+    _replace_writes(pending)
+
+
+def _sync_writes(pending: list[tuple[str, object, str | None]], fsync: bool, synced: list[str] | None = None) -> None:
+    """flush and close the files, synced collects every path once its content is complete"""
+    for file_path, f, _ in pending:
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+        if synced is not None:
+            synced.append(file_path)
+    for _, f, _ in pending:
+        f.close()
+
+
+def _replace_writes(pending: list[tuple[str, object, str | None]], replaced: list[str] | None = None) -> None:
+    """rename the closed temp files over their targets, replaced collects every path once it is in place"""
+    for file_path, _, tmp_path in pending:
+        if tmp_path:
+            os.replace(tmp_path, file_path)
+        if replaced is not None:
+            replaced.append(file_path)
+
+
+def _fsync_dirs(pending: list[tuple[str, object, str | None]]) -> None:
+    """sync each directory of the written files once, so new names and renames survive a crash"""
+    for directory in {os.path.dirname(os.path.abspath(file_path)) for file_path, _, _ in pending}:
+        _fsync_dir(directory)
+
+
+def _fsync_dir(directory: str) -> None:
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # directories cannot be opened for syncing on every platform
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _discard_writes(pending: list[tuple[str, object, str | None]]) -> None:
+    for _, f, tmp_path in pending:
+        try:
+            f.close()
+        except OSError:
+            # closing flushes what is still buffered, the write already failed with its own error
+            pass
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _written(file_path: str, appended_at: int | None = None) -> None:
+    content_cache.invalidate(os.path.realpath(file_path))
+    _reindex(file_path, appended_at)
+
+
 @mcp.tool()
-def write_file(file_path: str, content: str) -> dict:
+def write_file(file_path: str, content: str, atomic: bool = False, fsync: bool = False) -> dict:
     """
     安全写入文件内容
     Args:
         file_path: 相对于项目根目录的文件路径
         content: 要写入的内容
+        atomic: 先写入临时文件再重命名替换, 写入中途失败不会留下不完整的文件
+        fsync: 返回前将内容同步到磁盘
     Returns:
         操作结果状态
     """
@@ -55,9 +374,23 @@ def write_file(file_path: str, content: str) -> dict:
         if len(content.encode('utf-8')) > MAX_FILE_SIZE:
             return {"error": f"Content size exceeds limit of {MAX_FILE_SIZE} bytes"}
             
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'w', encoding='utf-8') as f:
+        f, tmp_path = _open_for_write(file_path, atomic)
+        pending = [(file_path, f, tmp_path)]
+        try:
             f.write(content)
+            _commit_writes(pending, fsync)
+        except BaseException:
+            _discard_writes(pending)
+            if tmp_path is None:
+                # the file was truncated in place
+                _written(file_path)
+            raise
+        _written(file_path)
+        if fsync:
+            try:
+                _fsync_dirs(pending)
+            except OSError as e:
+                return {"error": f"File was written but syncing its directory failed: {str(e)}", "file_path": file_path}
         return {
             "status": "success", 
             "file_path": file_path,
@@ -70,5 +403,360 @@ def write_file(file_path: str, content: str) -> dict:
     except Exception as e:
         return {"error": f"Failed to write file: {str(e)}"}
 
+
+@mcp.tool()
+def append_file(file_path: str, content: str, fsync: bool = False) -> dict:
+    """
+    在文件末尾追加内容, 文件不存在时创建, 适合日志类输出
+    Args:
+        file_path: 相对于项目根目录的文件路径
+        content: 要追加的内容
+        fsync: 返回前将内容同步到磁盘
+    Returns:
+        操作结果状态及追加后的文件大小
+    """
+    try:
+        appended = len(content.encode('utf-8'))
+        if appended > MAX_FILE_SIZE:
+            return {"error": f"Content size exceeds limit of {MAX_FILE_SIZE} bytes"}
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(file_path, 'a', encoding='utf-8') as f:
+            appended_at = os.fstat(f.fileno()).st_size
+            f.write(content)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+            file_size = os.fstat(f.fileno()).st_size
+        _written(file_path, appended_at)
+        return {
+            "status": "success",
+            "file_path": file_path,
+            "file_size": file_size,
+            "appended": appended
+        }
+    except PermissionError:
+        return {"error": "Permission denied"}
+    except IsADirectoryError:
+        return {"error": "Path is a directory"}
+    except Exception as e:
+        return {"error": f"Failed to append to file: {str(e)}"}
+
+
+@mcp.tool()
+def write_files(files: list[dict], atomic: bool = True, fsync: bool = False) -> dict:
+    """
+    批量写入多个文件
+    Args:
+        files: 要写入的文件列表, 每项为 {"file_path": 文件路径, "content": 内容}
+        atomic: 先全部写入临时文件再统一重命名, 写入失败时不修改任何文件; 重命名中途失败时, written为已被替换的文件数;
+            不使用atomic时written为已完整写入的文件数
+        fsync: 返回前将所有文件同步到磁盘, 同一批次只同步一轮
+    Returns:
+        每个文件的写入结果
+    """
+    if not files:
+        return {"error": "No files to write"}
+    if len(files) > MAX_BATCH_FILES:
+        return {"error": f"At most {MAX_BATCH_FILES} files can be written at once"}
+    for item in files:
+        if not isinstance(item, dict) or not isinstance(item.get("file_path"), str) or not isinstance(item.get("content"), str):
+            return {"error": "Every file needs a file_path and a content string"}
+        if len(item["content"].encode('utf-8')) > MAX_FILE_SIZE:
+            return {"error": f"Content of {item['file_path']} exceeds limit of {MAX_FILE_SIZE} bytes"}
+
+    # a directory in the way would only fail at its rename, after earlier files were replaced
+    for item in files:
+        if os.path.isdir(item["file_path"]):
+            return {"error": "Path is a directory", "file_path": item["file_path"], "written": 0}
+
+    pending = []
+    synced: list[str] = []
+    replaced: list[str] = []
+    current = 0
+    try:
+        for current, item in enumerate(files):
+            f, tmp_path = _open_for_write(item["file_path"], atomic)
+            pending.append((item["file_path"], f, tmp_path))
+            f.write(item["content"])
+        current = len(files)
+        _sync_writes(pending, fsync, synced)
+        _replace_writes(pending, replaced)
+    except Exception as e:
+        _discard_writes(pending)
+        if current < len(files):
+            failed = current
+        elif len(synced) < len(files):
+            failed = len(synced)
+        else:
+            failed = len(replaced)
+        if atomic:
+            # temp files are renamed only once all are synced, the renames done before a failure stay
+            written = len(replaced)
+            touched = written
+        else:
+            # without atomic every opened file was truncated, the ones synced before the failure are complete
+            written = len(synced)
+            touched = len(pending)
+        for item in files[:touched]:
+            _written(item["file_path"])
+        return {
+            "error": f"Failed to write files: {str(e)}",
+            "file_path": files[failed]["file_path"] if failed < len(files) else None,
+            "written": written,
+        }
+    for item in files:
+        _written(item["file_path"])
+    if fsync:
+        try:
+            _fsync_dirs(pending)
+        except OSError as e:
+            # every file is in place, only the renames may not survive a crash yet
+            return {
+                "error": f"Files were written but syncing their directories failed: {str(e)}",
+                "file_path": None,
+                "written": len(files),
+            }
+    return {
+        "status": "success",
+        "files": [
+            {"file_path": item["file_path"], "file_size": len(item["content"].encode('utf-8'))}
+            for item in files
+        ]
+    }
+
+
+class PatchError(ValueError):
+    """a patch that does not apply to the current file content"""
+
+
+class PatchOp:
+    """replace `count` lines starting at line `start` (1-based) with `new` lines
+
+    old holds the expected text of the replaced lines without line endings, None when
+    only the line range is known.
+    """
+    def __init__(self, start: int, count: int, new: list[str], old: list[str] | None = None, new_no_newline: bool = False):
+        self.start: int = start
+        self.count: int = count
+        self.new: list[str] = new
+        self.old: list[str] | None = old
+        # the last new line is written without a line ending ("\ No newline at end of file")
+        self.new_no_newline: bool = new_no_newline
+
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+# the line endings readline sees in a file opened with newline=''
+LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+
+def _split_lines(text: str) -> list[str]:
+    """split text where reading it from a file would, unlike str.splitlines form feeds and unicode line separators stay in the line"""
+    lines = LINE_BREAK.split(text)
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+def _parse_unified_diff(diff: str) -> list[PatchOp]:
+    ops: list[PatchOp] = []
+    lines = _split_lines(diff)
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        match = HUNK_HEADER.match(line)
+        if match is None:
+            if line.startswith("--- ") and ops:
+                raise PatchError("The diff changes more than one file")
+            i += 1
+            continue
+        old_start, old_count = int(match.group(1)), int(match.group(2) or 1)
+        new_count = int(match.group(4) or 1)
+        old, new = [], []
+        last_side = None
+        new_no_newline = False
+        i += 1
+        while i < len(lines) and (len(old) < old_count or len(new) < new_count or lines[i].startswith("\\")):
+            line = lines[i]
+            if line.startswith("\\"):
+                # applies to the line before it
+                new_no_newline = new_no_newline or last_side in ("+", " ")
+            elif line[:1] in (" ", ""):
+                old.append(line[1:])
+                new.append(line[1:])
+                last_side = " "
+            elif line[0] == "-":
+                old.append(line[1:])
+                last_side = "-"
+            elif line[0] == "+":
+                new.append(line[1:])
+                last_side = "+"
+            else:
+                raise PatchError(f"Invalid line in hunk: {line!r}")
+            i += 1
+        if len(old) != old_count or len(new) != new_count:
+            raise PatchError(f"Hunk at line {old_start} is truncated")
+        # a hunk without old lines inserts after old_start
+        ops.append(PatchOp(old_start if old_count else old_start + 1, old_count, new, old, new_no_newline))
+    if not ops:
+        raise PatchError("No hunks found in the diff")
+    return ops
+
+
+def _parse_edits(edits: list[dict]) -> list[PatchOp]:
+    ops = []
+    for edit in edits:
+        if not isinstance(edit, dict) or not isinstance(edit.get("start_line"), int):
+            raise PatchError("Every edit needs an integer start_line")
+        start = edit["start_line"]
+        end = edit.get("end_line", start)
+        content = edit.get("content", "")
+        expected = edit.get("expected")
+        if start < 1 or not isinstance(end, int) or end < start - 1 or not isinstance(content, str):
+            raise PatchError(f"Invalid edit at line {start}")
+        old = _split_lines(expected) if isinstance(expected, str) else None
+        if old is not None and len(old) != end - start + 1:
+            raise PatchError(f"expected of the edit at line {start} must have {end - start + 1} lines")
+        ops.append(PatchOp(start, end - start + 1, _split_lines(content), old))
+    return sorted(ops, key=lambda op: op.start)
+
+
+def _apply_patch(src, dst, ops: list[PatchOp], keep_missing_newline: bool) -> None:
+    """copy src to dst line by line, applying ops in order, only the current line is held in memory"""
+    # new lines use the line ending of the file
+    first = src.readline()
+    eol = first[len(first.rstrip("\r\n")):] or "\n"
+    src.seek(0)
+    line_no = 0
+    ends_with_newline = True
+    for op in ops:
+        while line_no < op.start - 1:
+            line = src.readline()
+            if not line:
+                raise PatchError(f"Line {op.start} is past the end of the file ({line_no} lines)")
+            line_no += 1
+            dst.write(line)
+            ends_with_newline = line.endswith("\n")
+        last = "\n"
+        for index in range(op.count):
+            line = src.readline()
+            if not line:
+                raise PatchError(f"Line {line_no + 1} is past the end of the file ({line_no} lines)")
+            line_no += 1
+            found = line.rstrip("\r\n")
+            if op.old is not None and found != op.old[index]:
+                raise PatchError(f"Context mismatch at line {line_no}: expected {op.old[index]!r}, found {found!r}")
+            last = line
+        if not op.new:
+            continue
+        if not ends_with_newline:
+            # inserting after a last line that had no line ending
+            dst.write(eol)
+        for index, text in enumerate(op.new):
+            final = index == len(op.new) - 1
+            no_newline = op.new_no_newline or (keep_missing_newline and op.count and not last.endswith("\n"))
+            dst.write(text if final and no_newline else text + eol)
+        ends_with_newline = not no_newline
+    rest = src.read(1)
+    if rest:
+        if not ends_with_newline:
+            dst.write(eol)
+        dst.write(rest)
+        shutil.copyfileobj(src, dst)
+
+
+@mcp.tool()
+def patch_file(file_path: str, diff: str | None = None, edits: list[dict] | None = None, fsync: bool = False) -> dict:
+    """
+    按补丁修改文件, 只需发送改动部分; 上下文与文件内容不一致时拒绝修改
+    Args:
+        file_path: 相对于项目根目录的文件路径
+        diff: 统一diff格式的补丁(@@ -起始行,行数 +起始行,行数 @@)
+        edits: 按行范围替换, 每项为 {"start_line": 起始行, "end_line": 结束行(包含), "content": 新内容,
+            "expected": 原内容(可选, 不一致时拒绝)}; end_line为start_line-1时表示在start_line前插入
+        fsync: 返回前将内容同步到磁盘
+    Returns:
+        操作结果状态及增删行数
+    """
+    if (diff is None) == (edits is None):
+        return {"error": "Give either diff or edits"}
+    try:
+        ops = _parse_unified_diff(diff) if diff is not None else _parse_edits(edits)
+        previous_end = 0
+        for op in ops:
+            if op.start <= previous_end:
+                raise PatchError(f"Changes at line {op.start} overlap the previous change")
+            previous_end = op.start + op.count - 1
+        with open(file_path, 'r', encoding='utf-8', newline='') as src:
+            # the file is rewritten through a temp file, so a rejected patch changes nothing
+            dst, tmp_path = _open_for_write(file_path, atomic=True, newline='')
+            pending = [(file_path, dst, tmp_path)]
+            try:
+                _apply_patch(src, dst, ops, keep_missing_newline=diff is None)
+                _commit_writes(pending, fsync)
+            except BaseException:
+                _discard_writes(pending)
+                raise
+        _written(file_path)
+        if fsync:
+            try:
+                _fsync_dirs(pending)
+            except OSError as e:
+                return {"error": f"File was patched but syncing its directory failed: {str(e)}", "file_path": file_path}
+        return {
+            "status": "success",
+            "file_path": file_path,
+            "file_size": os.path.getsize(file_path),
+            "changes": len(ops),
+            "lines_removed": sum(op.count for op in ops),
+            "lines_added": sum(len(op.new) for op in ops)
+        }
+    except PatchError as e:
+        return {"error": str(e)}
+    except FileNotFoundError:
+        return {"error": "File not found"}
+    except PermissionError:
+        return {"error": "Permission denied"}
+    except UnicodeDecodeError:
+        return {"error": "File encoding not supported"}
+    except Exception as e:
+        return {"error": f"Failed to patch file: {str(e)}"}
+
+
+def _reindex(file_path: str, appended_at: int | None = None) -> None:
+    """keep search results current after a write, a failure only delays it to the next rescan"""
+    try:
+        search_index.update_file(file_path, appended_at)
+    except Exception as e:
+        logging.warning(f"Failed to update search index for {file_path}: {e}")
+
+
+@mcp.tool()
+def search_files(query: str, top_k: int = 5) -> dict:
+    """
+    在数据目录的文件中全文搜索, 按相关度(BM25)排序, 支持中文
+    Args:
+        query: 搜索关键词, 多个关键词用空格分隔
+        top_k: 最多返回的文件数, 默认为5
+    Returns:
+        匹配的文件路径、得分以及带行号的匹配片段
+    """
+    try:
+        return search_index.search(query, top_k=max(top_k, 1))
+    except Exception as e:
+        return {"error": f"Failed to search files: {str(e)}"}
+
+
+@mcp.tool()
+def file_cache_stats() -> dict:
+    """
+    诊断工具: 查看文件内容缓存的命中、未命中、淘汰次数及占用字节数
+    Returns:
+        缓存统计信息
+    """
+    return content_cache.stats()
+
+
 if __name__ == "__main__":
     mcp.run(transport="stdio")
\ No newline at end of file
@@ -0,0 +1,213 @@
+"""
+@Desc    :   multi-user http/websocket gateway, every conversation is a fork of one ChatSession
+"""
+# -*-coding:utf-8 -*-
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from client import ChatSession, LLMClient
+
+
+class Conversation:
+    """one user conversation, turns of the same conversation run one at a time"""
+    def __init__(self, session: ChatSession):
+        self.id: str = uuid.uuid4().hex
+        self.session: ChatSession = session
+        self.lock: asyncio.Lock = asyncio.Lock()
+        self.last_active: float = time.monotonic()
+
+
+class ChatGateway:
+    """host many isolated conversations on one set of mcp servers and one pooled llm client"""
+    def __init__(
+        self,
+        chat_session: ChatSession,
+        max_sessions: int = 1000,
+        max_concurrent_turns: int = 32,
+        idle_timeout: float = 1800.0,
+        max_tool_rounds: int = 10,
+    ):
+        # owner of the shared servers, never used for a conversation itself
+        self.chat_session: ChatSession = chat_session
+        self.max_sessions: int = max_sessions
+        self.idle_timeout: float = idle_timeout
+        self.max_tool_rounds: int = max_tool_rounds
+        self.conversations: dict[str, Conversation] = {}
+        self._turns: asyncio.Semaphore = asyncio.Semaphore(max_concurrent_turns)
+        self._evict_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        await self.chat_session.start_session()
+        self._evict_task = asyncio.create_task(self._evict_idle())
+
+    async def stop(self) -> None:
+        if self._evict_task:
+            self._evict_task.cancel()
+            await asyncio.gather(self._evict_task, return_exceptions=True)
+        for conversation in list(self.conversations.values()):
+            await self.close(conversation.id)
+        await self.chat_session.close_session()
+        await LLMClient.close_http_client()
+
+    async def open(self) -> Conversation | None:
+        """start a conversation, None when max_sessions is reached"""
+        if len(self.conversations) >= self.max_sessions:
+            return None
+        conversation = Conversation(self.chat_session.fork())
+        await conversation.session.reset_session()
+        self.conversations[conversation.id] = conversation
+        return conversation
+
+    async def close(self, conversation_id: str) -> bool:
+        conversation = self.conversations.pop(conversation_id, None)
+        if conversation is None:
+            return False
+        await conversation.session.close_session()
+        return True
+
+    async def turn(self, conversation: Conversation, content: str, on_token=None, on_tool_results=None) -> str:
+        async with conversation.lock, self._turns:
+            conversation.last_active = time.monotonic()
+            try:
+                # history of the conversation is kept, the context window bounds its size
+                await conversation.session.refresh_system_prompt()
+                return await conversation.session.run_turn(
+                    content,
+                    on_token=on_token,
+                    on_tool_results=on_tool_results,
+                    max_tool_rounds=self.max_tool_rounds,
+                )
+            finally:
+                conversation.last_active = time.monotonic()
+
+    async def _evict_idle(self) -> None:
+        while True:
+            await asyncio.sleep(min(self.idle_timeout / 4, 60.0))
+            deadline = time.monotonic() - self.idle_timeout
+            for conversation in list(self.conversations.values()):
+                if conversation.last_active < deadline and not conversation.lock.locked():
+                    logging.info(f"Evicting idle conversation {conversation.id}")
+                    await self.close(conversation.id)
+
+
+def create_app(gateway: ChatGateway) -> Starlette:
+    async def create_conversation(request: Request):
+        conversation = await gateway.open()
+        if conversation is None:
+            return JSONResponse({"error": "too many sessions"}, status_code=503)
+        return JSONResponse({"session_id": conversation.id})
+
+    async def delete_conversation(request: Request):
+        if not await gateway.close(request.path_params["session_id"]):
+            return JSONResponse({"error": "session not found"}, status_code=404)
+        return JSONResponse({"status": "closed"})
+
+    async def post_message(request: Request):
+        conversation = gateway.conversations.get(request.path_params["session_id"])
+        if conversation is None:
+            return JSONResponse({"error": "session not found"}, status_code=404)
+        try:
+            body = await request.json()
+        except ValueError:
+            return JSONResponse({"error": "invalid json"}, status_code=400)
+        content = body.get("content") if isinstance(body, dict) else None
+        if not content:
+            return JSONResponse({"error": "content is required"}, status_code=400)
+        tool_results: list[str] = []
+        answer = await gateway.turn(conversation, content, on_tool_results=tool_results.append)
+        return JSONResponse({
+            "answer": answer,
+            "tool_results": tool_results,
+            "prompt_tokens": conversation.session.turn_prompt_tokens,
+        })
+
+    async def conversation_socket(websocket: WebSocket):
+        """send {"content": ...}, receive {"type": "token"|"tool_results"|"answer", ...}"""
+        conversation = gateway.conversations.get(websocket.path_params["session_id"])
+        if conversation is None:
+            await websocket.close(code=4404)
+            return
+        await websocket.accept()
+        try:
+            while True:
+                try:
+                    message = json.loads(await websocket.receive_text())
+                except ValueError:
+                    await websocket.send_json({"type": "error", "error": "invalid json"})
+                    continue
+                content = message.get("content") if isinstance(message, dict) else None
+                if not content:
+                    await websocket.send_json({"type": "error", "error": "content is required"})
+                    continue
+                # callbacks are sync, a queue keeps websocket sends ordered
+                events: asyncio.Queue = asyncio.Queue()
+                turn = asyncio.create_task(gateway.turn(
+                    conversation,
+                    content,
+                    on_token=lambda token: events.put_nowait({"type": "token", "text": token}),
+                    on_tool_results=lambda text: events.put_nowait({"type": "tool_results", "text": text}),
+                ))
+                turn.add_done_callback(lambda _: events.put_nowait(None))
+                while (event := await events.get()) is not None:
+                    await websocket.send_json(event)
+                if turn.exception() is not None:
+                    logging.error(f"Turn of conversation {conversation.id} failed: {turn.exception()}")
+                    await websocket.send_json({"type": "error", "error": str(turn.exception())})
+                else:
+                    await websocket.send_json({"type": "answer", "text": turn.result()})
+        except WebSocketDisconnect:
+            pass
+
+    @asynccontextmanager
+    async def lifespan(app):
+        await gateway.start()
+        try:
+            yield
+        finally:
+            await gateway.stop()
+
+    return Starlette(
+        routes=[
+            Route("/sessions", create_conversation, methods=["POST"]),
+            Route("/sessions/{session_id}", delete_conversation, methods=["DELETE"]),
+            Route("/sessions/{session_id}/messages", post_message, methods=["POST"]),
+            WebSocketRoute("/sessions/{session_id}/ws", conversation_socket),
+        ],
+        lifespan=lifespan,
+    )
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="servers_config.json", help="config file path")
+    parser.add_argument("--servers", nargs="*", help="servers to connect")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="listen address")
+    parser.add_argument("--port", type=int, default=8080, help="listen port")
+    parser.add_argument("--max-sessions", type=int, default=1000, help="max open conversations")
+    parser.add_argument("--max-concurrent-turns", type=int, default=32, help="max turns processed at once")
+    parser.add_argument("--idle-timeout", type=float, default=1800.0, help="seconds before an idle conversation is evicted")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    gateway = ChatGateway(
+        ChatSession.create(args.config, args.servers),
+        max_sessions=args.max_sessions,
+        max_concurrent_turns=args.max_concurrent_turns,
+        idle_timeout=args.idle_timeout,
+    )
+    uvicorn.run(create_app(gateway), host=args.host, port=args.port)
@@ -0,0 +1,89 @@
+"""
+@Desc : content addressed store for image and binary tool results
+"""
+import asyncio
+import base64
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Union
+
+# files managed by the store, other files in the output directory are never touched
+STORED_FILE_PATTERN = re.compile(r"^(image|blob)_[0-9a-f]{16}\.\w+$")
+
+
+class MediaStore:
+    """write decoded tool results off the event loop, named by content hash
+
+    the same content is stored once, and when max_bytes is set the least recently
+    stored or requested files are deleted to stay within the quota.
+    """
+    def __init__(self, output_dir: Union[str, Path] = ".", max_bytes: int | None = None):
+        self.output_dir: Path = Path(output_dir)
+        self.max_bytes: int | None = max_bytes
+        # a single writer thread keeps the index consistent without locks
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="media-store")
+        # file name -> size, least recently used first
+        self._index: OrderedDict[str, int] | None = None
+        self._bytes: int = 0
+
+    def _load_index(self) -> None:
+        self._index = OrderedDict()
+        if self.output_dir.is_dir():
+            files = [
+                entry for entry in os.scandir(self.output_dir)
+                if entry.is_file() and STORED_FILE_PATTERN.match(entry.name)
+            ]
+            for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+                self._index[entry.name] = entry.stat().st_size
+        self._bytes = sum(self._index.values())
+
+    async def save(self, data: str, mime_type: str | None = None, kind: str = "image") -> Path:
+        """store base64 encoded data and return the file path"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._write, data, mime_type, kind)
+
+    def _write(self, data: str, mime_type: str | None, kind: str) -> Path:
+        if self._index is None:
+            self._load_index()
+        raw = base64.b64decode(data)
+        extension = (mimetypes.guess_extension(mime_type) if mime_type else None) or (".jpg" if kind == "image" else ".bin")
+        name = f"{kind}_{hashlib.sha256(raw).hexdigest()[:16]}{extension}"
+        path = self.output_dir / name
+        if name in self._index and path.exists():
+            # already stored, mark as recently used
+            self._index.move_to_end(name)
+            os.utime(path)
+            return path
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(name + ".tmp")
+        tmp_path.write_bytes(raw)
+        os.replace(tmp_path, path)
+        self._bytes += len(raw) - self._index.pop(name, 0)
+        self._index[name] = len(raw)
+        self._enforce_quota(keep=name)
+        return path
+
+    def _enforce_quota(self, keep: str) -> None:
+        if self.max_bytes is None:
+            return
+        for name in list(self._index):
+            if self._bytes <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            size = self._index.pop(name)
+            self._bytes -= size
+            try:
+                os.remove(self.output_dir / name)
+            except FileNotFoundError:
+                pass
+            logging.info(f"Removed {name} from media store to stay within {self.max_bytes} bytes")
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
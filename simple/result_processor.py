@@ -0,0 +1,226 @@
+"""
+@Desc : size aware post processing of tool results before they reach the llm
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Union
+
+from mcp.types import CallToolResult, TextContent
+
+from context_window import count_text_tokens
+
+# name of the local tool the llm uses to page through a spilled result
+READ_RESULT_TOOL = "read_tool_result"
+READ_RESULT_TOOL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "handle": {"type": "string", "description": "被截断的工具结果的句柄"},
+        "offset": {"type": "integer", "description": "起始字节偏移, 默认为0"},
+        "length": {"type": "integer", "description": "读取的字节数, 默认为4000"},
+    },
+    "required": ["handle"],
+}
+# files managed by the spill directory, other files in it are never touched
+SPILL_FILE_PATTERN = re.compile(r"^[0-9a-f]{16}\.txt$")
+
+
+class ResultLimits:
+    """byte and token limits of the text sent to the llm for one tool"""
+    def __init__(self, max_bytes: int = 16 * 1024, max_tokens: int = 4000):
+        self.max_bytes: int = max_bytes
+        self.max_tokens: int = max_tokens
+
+
+class ToolResultProcessor:
+    """truncate or digest oversized text results, the full payload is spilled to a local handle
+
+    spilled results that were not stored or read for max_spill_age seconds are deleted, and
+    the least recently used ones are deleted to keep the directory within max_spill_bytes.
+    """
+    def __init__(
+        self,
+        spill_dir: Union[str, Path] = ".tool_results",
+        max_bytes: int = 16 * 1024,
+        max_tokens: int = 4000,
+        tools: dict[str, dict[str, int]] | None = None,
+        max_spill_bytes: int | None = 256 * 1024 * 1024,
+        max_spill_age: float | None = 24 * 3600.0,
+    ):
+        self.spill_dir: Path = Path(spill_dir)
+        self.max_spill_bytes: int | None = max_spill_bytes
+        self.max_spill_age: float | None = max_spill_age
+        # handle -> (size, last stored or read), least recently used first
+        self._spilled: OrderedDict[str, tuple[int, float]] | None = None
+        self._spilled_bytes: int = 0
+        self.default_limits: ResultLimits = ResultLimits(max_bytes, max_tokens)
+        # per tool overrides, "tools": {"<tool>": {"max_bytes", "max_tokens"}}
+        self.tool_limits: dict[str, ResultLimits] = {
+            tool_name: ResultLimits(**limits) for tool_name, limits in (tools or {}).items()
+        }
+
+    def limits(self, tool_name: str) -> ResultLimits:
+        return self.tool_limits.get(tool_name, self.default_limits)
+
+    def process(self, tool_name: str, result: Any) -> Any:
+        """return the result with oversized text items replaced, the input is never modified"""
+        if not isinstance(result, CallToolResult):
+            return result
+        limits = self.limits(tool_name)
+        content = []
+        changed = False
+        for item in result.content:
+            if item.type == "text":
+                text = self.process_text(item.text, limits)
+                if text is not item.text:
+                    item = TextContent(type="text", text=text)
+                    changed = True
+            content.append(item)
+        # results may be shared with the result cache, copy instead of mutating
+        return result.model_copy(update={"content": content}) if changed else result
+
+    def process_text(self, text: str, limits: ResultLimits) -> str:
+        size = len(text.encode("utf-8"))
+        if size <= limits.max_bytes and count_text_tokens(text) <= limits.max_tokens:
+            return text
+        handle = self.spill(text)
+        note = (
+            f"[结果过大({size} 字节), 完整内容已保存, 句柄 handle={handle}, "
+            f"可调用 {READ_RESULT_TOOL} 按字节偏移分页读取, 无需重新执行工具]"
+        )
+        digest = self._digest_json(text, limits)
+        if digest is not None:
+            logging.info(f"Tool result of {size} bytes digested as json, handle {handle}")
+            return f"{note}\nJSON结构摘要:\n{digest}"
+        logging.info(f"Tool result of {size} bytes truncated, handle {handle}")
+        return self._head_tail(text, size, limits, note)
+
+    @staticmethod
+    def _budget_chars(text: str, size: int, limits: ResultLimits) -> int:
+        ratio = min(limits.max_bytes / size, limits.max_tokens / max(count_text_tokens(text), 1))
+        # leave room for the note and the omission marker
+        return max(int(len(text) * ratio * 0.9), 0)
+
+    def _head_tail(self, text: str, size: int, limits: ResultLimits, note: str) -> str:
+        keep = self._budget_chars(text, size, limits)
+        head, tail = keep * 2 // 3, keep // 3
+        omitted = len(text) - head - tail
+        tail_text = text[-tail:] if tail else ""
+        return f"{note}\n{text[:head]}\n...[省略 {omitted} 个字符]...\n{tail_text}"
+
+    def _digest_json(self, text: str, limits: ResultLimits) -> str | None:
+        """describe the structure of a json result, None when text is not json or the digest is too big"""
+        stripped = text.lstrip()
+        if not stripped.startswith(("{", "[")):
+            return None
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return None
+        digest = json.dumps(self._shape(data, depth=0), ensure_ascii=False, indent=1)
+        if len(digest.encode("utf-8")) > limits.max_bytes or count_text_tokens(digest) > limits.max_tokens:
+            return None
+        return digest
+
+    def _shape(self, value: Any, depth: int) -> Any:
+        if isinstance(value, dict):
+            if depth >= 3:
+                return f"<object, {len(value)} keys>"
+            return {key: self._shape(item, depth + 1) for key, item in list(value.items())[:50]}
+        if isinstance(value, list):
+            if depth >= 3 or not value:
+                return f"<array, {len(value)} items>"
+            return [f"<array, {len(value)} items, first item:>", self._shape(value[0], depth + 1)]
+        if isinstance(value, str) and len(value) > 200:
+            return value[:200] + f"...<string, {len(value)} chars>"
+        return value
+
+    def _load_spilled(self) -> None:
+        self._spilled = OrderedDict()
+        if self.spill_dir.is_dir():
+            files = [
+                (entry.name[:-len(".txt")], entry.stat())
+                for entry in os.scandir(self.spill_dir)
+                if entry.is_file() and SPILL_FILE_PATTERN.match(entry.name)
+            ]
+            for handle, stat in sorted(files, key=lambda item: item[1].st_mtime):
+                self._spilled[handle] = (stat.st_size, stat.st_mtime)
+        self._spilled_bytes = sum(size for size, _ in self._spilled.values())
+
+    def _touch(self, handle: str, path: Path) -> None:
+        """mark a spilled result as recently used"""
+        if self._spilled is None:
+            self._load_spilled()
+        entry = self._spilled.get(handle)
+        if entry is None:
+            return
+        self._spilled[handle] = (entry[0], time.time())
+        self._spilled.move_to_end(handle)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def spill(self, text: str) -> str:
+        if self._spilled is None:
+            self._load_spilled()
+        data = text.encode("utf-8")
+        handle = hashlib.sha256(data).hexdigest()[:16]
+        path = self.spill_dir / f"{handle}.txt"
+        if handle in self._spilled and path.exists():
+            self._touch(handle, path)
+        else:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+            self._spilled_bytes += len(data) - self._spilled.pop(handle, (0, 0.0))[0]
+            self._spilled[handle] = (len(data), time.time())
+        self._enforce_spill_quota(keep=handle)
+        return handle
+
+    def _enforce_spill_quota(self, keep: str) -> None:
+        expired_before = time.time() - self.max_spill_age if self.max_spill_age is not None else None
+        for handle, (size, used_at) in list(self._spilled.items()):
+            over_quota = self.max_spill_bytes is not None and self._spilled_bytes > self.max_spill_bytes
+            if not over_quota and (expired_before is None or used_at >= expired_before):
+                break
+            if handle == keep:
+                continue
+            del self._spilled[handle]
+            self._spilled_bytes -= size
+            try:
+                os.remove(self.spill_dir / f"{handle}.txt")
+            except FileNotFoundError:
+                pass
+            logging.info(f"Removed spilled tool result {handle}")
+
+    def read(self, handle: str, offset: int = 0, length: int = 4000) -> str:
+        """read a page of a spilled result, offsets are bytes aligned to utf-8 characters"""
+        if not handle.isalnum():
+            return f"Invalid handle {handle}"
+        path = self.spill_dir / f"{handle}.txt"
+        try:
+            size = path.stat().st_size
+            with open(path, "rb") as f:
+                f.seek(max(offset, 0))
+                data = f.read(max(length, 0) + 3)
+        except FileNotFoundError:
+            return f"No tool result with handle {handle}"
+        self._touch(handle, path)
+        # skip a partial character at the start, stop before a partial one at the end
+        start = 0
+        while start < len(data) and data[start] & 0xC0 == 0x80:
+            start += 1
+        end = min(start + max(length, 0), len(data))
+        while 0 < end < len(data) and data[end] & 0xC0 == 0x80:
+            end -= 1
+        begin = max(offset, 0) + start
+        next_offset = begin + (end - start)
+        page = data[start:end].decode("utf-8", errors="replace")
+        footer = f"\n[字节 {begin}-{next_offset} / {size}"
+        footer += f", 下一页 offset={next_offset}]" if next_offset < size else ", 已读完]"
+        return page + footer
@@ -0,0 +1,286 @@
+"""
+@Desc : on-disk inverted index with bm25 ranking for the file_server search tool
+"""
+import json
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Any, Union
+
+# latin words and digits, or runs of CJK characters
+TOKEN_PATTERN = re.compile(r"[0-9a-z_]+|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af]+")
+INDEX_VERSION = 1
+
+
+def tokenize(text: str, query: bool = False) -> list[str]:
+    """split text into terms, CJK runs become overlapping bigrams
+
+    documents also index every CJK character, so a one character query still matches;
+    queries of two or more CJK characters only use bigrams, which keeps them precise.
+    """
+    terms = []
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group()
+        if token[0] < "\u0080":
+            terms.append(token)
+            continue
+        if len(token) == 1 or not query:
+            terms.extend(token)
+        terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return terms
+
+
+class SearchIndex:
+    """bm25 full-text index over the text files under root
+
+    postings keep, per file, the lines a term occurs on with their byte offsets, so
+    snippets are read with one seek per line. files are reindexed when their mtime or
+    size changes, which is checked at most every rescan_interval seconds, or right away
+    through update_file. the index is written back at most every save_interval seconds,
+    a stale index on disk is brought up to date by the mtime check when it is loaded.
+    """
+    def __init__(
+        self,
+        root: Union[str, Path],
+        index_path: Union[str, Path, None] = None,
+        max_file_size: int = 2 * 1024 * 1024,
+        rescan_interval: float = 2.0,
+        save_interval: float = 5.0,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.root: Path = Path(root)
+        self.index_path: Path = Path(index_path) if index_path else self.root / ".search_index.json"
+        self.max_file_size: int = max_file_size
+        self.rescan_interval: float = rescan_interval
+        self.save_interval: float = save_interval
+        self.k1: float = k1
+        self.b: float = b
+        # relative path -> {"mtime_ns", "size", "length", "terms", "lines", "ends_with_newline"},
+        # "lines" is None for skipped (too large or binary) files
+        self.docs: dict[str, dict[str, Any]] | None = None
+        # term -> relative path -> [[line, byte offset, count], ...]
+        self.postings: dict[str, dict[str, list[list[int]]]] = {}
+        self._total_length: int = 0
+        self._scanned_at: float = 0.0
+        self._saved_at: float = 0.0
+        self._dirty: bool = False
+
+    def _load(self) -> None:
+        self.docs, self.postings = {}, {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == INDEX_VERSION and data.get("root") == str(self.root.resolve()):
+                self.docs, self.postings = data["docs"], data["postings"]
+        except (OSError, ValueError, KeyError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning(f"Ignoring unreadable search index {self.index_path}: {e}")
+        self._total_length = sum(doc["length"] for doc in self.docs.values())
+
+    def save(self, force: bool = True) -> None:
+        if not self._dirty or (not force and time.monotonic() - self._saved_at < self.save_interval):
+            return
+        tmp_path = self.index_path.with_name(self.index_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": INDEX_VERSION, "root": str(self.root.resolve()), "docs": self.docs, "postings": self.postings},
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp_path, self.index_path)
+        self._saved_at = time.monotonic()
+        self._dirty = False
+
+    def _walk(self) -> dict[str, os.stat_result]:
+        files = {}
+        stack = [self.root]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                # hidden files hold the index, spilled results and caches
+                if entry.name.startswith(".") or entry.name == "__pycache__":
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(Path(entry.path))
+                elif entry.is_file():
+                    files[Path(entry.path).relative_to(self.root).as_posix()] = entry.stat()
+        return files
+
+    def refresh(self, force: bool = False) -> None:
+        """reindex files whose mtime or size changed and drop deleted files"""
+        if self.docs is None:
+            self._load()
+            force = True
+        if not force and time.monotonic() - self._scanned_at < self.rescan_interval:
+            return
+        files = self._walk()
+        for rel_path in [rel_path for rel_path in self.docs if rel_path not in files]:
+            self._remove(rel_path)
+        for rel_path, stat in files.items():
+            doc = self.docs.get(rel_path)
+            if doc is None or doc["mtime_ns"] != stat.st_mtime_ns or doc["size"] != stat.st_size:
+                self._index(rel_path, stat)
+        self._scanned_at = time.monotonic()
+        self.save(force=False)
+
+    def update_file(self, path: Union[str, Path], appended_at: int | None = None) -> None:
+        """reindex one file right after it was written, paths outside root are ignored
+
+        Args:
+            appended_at: size of the file before an append, only the appended lines are
+                indexed when the index is current up to there
+        """
+        if self.docs is None:
+            self.refresh()
+            return
+        try:
+            rel_path = Path(path).resolve().relative_to(self.root.resolve()).as_posix()
+        except ValueError:
+            return
+        if any(part.startswith(".") or part == "__pycache__" for part in Path(rel_path).parts):
+            return
+        try:
+            stat = os.stat(self.root / rel_path)
+        except FileNotFoundError:
+            self._remove(rel_path)
+            self.save(force=False)
+            return
+        doc = self.docs.get(rel_path)
+        if (
+            appended_at is not None
+            and doc is not None
+            and doc["size"] == appended_at
+            and doc.get("lines") is not None
+            and doc.get("ends_with_newline")
+            and stat.st_size <= self.max_file_size
+        ):
+            self._index_tail(rel_path, stat, doc)
+        else:
+            self._index(rel_path, stat)
+        self.save(force=False)
+
+    def _remove(self, rel_path: str) -> None:
+        doc = self.docs.pop(rel_path, None)
+        if doc is None:
+            return
+        for term in doc["terms"]:
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(rel_path, None)
+                if not postings:
+                    del self.postings[term]
+        self._total_length -= doc["length"]
+        self._dirty = True
+
+    def _index(self, rel_path: str, stat: os.stat_result) -> None:
+        self._remove(rel_path)
+        doc = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "length": 0, "terms": []}
+        self.docs[rel_path] = doc
+        self._dirty = True
+        if stat.st_size > self.max_file_size:
+            return
+        try:
+            lines, length, line_count, ends_with_newline = self._scan(rel_path, 0, 0)
+        except (OSError, UnicodeDecodeError):
+            # binary or unreadable, remembered so it is not retried until it changes
+            return
+        for term, occurrences in lines.items():
+            self.postings.setdefault(term, {})[rel_path] = occurrences
+        doc.update(length=length, terms=list(lines), lines=line_count, ends_with_newline=ends_with_newline)
+        self._total_length += length
+
+    def _index_tail(self, rel_path: str, stat: os.stat_result, doc: dict[str, Any]) -> None:
+        """index the lines appended after the indexed size of the file"""
+        try:
+            lines, length, line_count, ends_with_newline = self._scan(rel_path, doc["size"], doc["lines"])
+        except (OSError, UnicodeDecodeError):
+            self._index(rel_path, stat)
+            return
+        known = set(doc["terms"])
+        for term, occurrences in lines.items():
+            self.postings.setdefault(term, {}).setdefault(rel_path, []).extend(occurrences)
+            if term not in known:
+                doc["terms"].append(term)
+        doc.update(
+            mtime_ns=stat.st_mtime_ns,
+            size=stat.st_size,
+            length=doc["length"] + length,
+            lines=line_count,
+            ends_with_newline=ends_with_newline,
+        )
+        self._total_length += length
+        self._dirty = True
+
+    def _scan(self, rel_path: str, offset: int, line_count: int) -> tuple[dict[str, list[list[int]]], int, int, bool]:
+        """postings of the lines from the byte offset on, numbered after line_count
+
+        Returns:
+            (term -> occurrences, number of terms, line count, whether the file ends with a newline)
+        """
+        lines: dict[str, list[list[int]]] = defaultdict(list)
+        length = 0
+        raw = b"\n"
+        with open(self.root / rel_path, "rb") as f:
+            f.seek(offset)
+            for line_count, raw in enumerate(f, start=line_count + 1):
+                terms = Counter(tokenize(raw.decode("utf-8")))
+                for term, count in terms.items():
+                    lines[term].append([line_count, offset, count])
+                length += sum(terms.values())
+                offset += len(raw)
+        return lines, length, line_count, raw.endswith(b"\n")
+
+    def search(self, query: str, top_k: int = 5, snippets: int = 3) -> dict[str, Any]:
+        self.refresh()
+        terms = list(dict.fromkeys(tokenize(query, query=True)))
+        indexed = sum(1 for doc in self.docs.values() if doc["length"])
+        if not terms or not indexed:
+            return {"results": [], "total_matches": 0, "indexed_files": indexed}
+        average_length = self._total_length / indexed
+        scores: dict[str, float] = defaultdict(float)
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (indexed - len(postings) + 0.5) / (len(postings) + 0.5))
+            for rel_path, occurrences in postings.items():
+                tf = sum(occurrence[2] for occurrence in occurrences)
+                norm = self.k1 * (1 - self.b + self.b * self.docs[rel_path]["length"] / average_length)
+                scores[rel_path] += idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return {
+            "results": [
+                {"path": str(self.root / rel_path), "score": round(score, 4), "snippets": self._snippets(rel_path, terms, snippets)}
+                for rel_path, score in ranked
+            ],
+            "total_matches": len(scores),
+            "indexed_files": indexed,
+        }
+
+    def _snippets(self, rel_path: str, terms: list[str], limit: int) -> list[dict[str, Any]]:
+        """the lines matching the most distinct query terms, in file order"""
+        lines: dict[int, list[int]] = {}
+        for term in terms:
+            for number, offset, count in self.postings.get(term, {}).get(rel_path, []):
+                line = lines.setdefault(number, [offset, 0, 0])
+                line[1] += 1
+                line[2] += count
+        best = sorted(lines.items(), key=lambda item: (-item[1][1], -item[1][2], item[0]))[:limit]
+        snippets = []
+        try:
+            with open(self.root / rel_path, "rb") as f:
+                for number, (offset, _, _) in sorted(best):
+                    f.seek(offset)
+                    text = f.readline().decode("utf-8", errors="replace").strip()
+                    snippets.append({"line": number, "text": text[:200] + ("..." if len(text) > 200 else "")})
+        except OSError as e:
+            logging.warning(f"Failed to read snippets of {rel_path}: {e}")
+        return snippets
@@ -0,0 +1,194 @@
+"""
+@Desc : lightweight tracing spans with pluggable exporters (jsonl file, chrome trace format)
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Iterator, Union
+
+_current_span: ContextVar["Span | None"] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """one timed phase, spans started inside another span become its children"""
+    def __init__(self, tracer: "Tracer", name: str, parent: "Span | None", attributes: dict[str, Any]):
+        self.tracer: "Tracer" = tracer
+        self.name: str = name
+        self.span_id: int = next(tracer._ids)
+        self.parent_id: int | None = parent.span_id if parent else None
+        self.trace_id: int = parent.trace_id if parent else self.span_id
+        self.attributes: dict[str, Any] = attributes
+        self.start: float = time.time()
+        self.duration: float | None = None
+        self.error: str | None = None
+        self.thread: int = tracer._thread_id()
+        self._started: float = time.perf_counter()
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def end(self, error: BaseException | None = None) -> None:
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        if error is not None:
+            self.error = str(error) or type(error).__name__
+        self.tracer._export(self)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class SpanExporter(ABC):
+    """receives every finished span"""
+    @abstractmethod
+    def export(self, span: Span) -> None:
+        ...
+
+    def close(self) -> None:
+        pass
+
+
+class JsonlExporter(SpanExporter):
+    """one json object per finished span"""
+    def __init__(self, path: Union[str, Path]):
+        self.path: Path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def export(self, span: Span) -> None:
+        self._file.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ChromeTraceExporter(SpanExporter):
+    """complete events in the chrome trace event format, open the file in chrome://tracing or perfetto
+
+    events are written as they finish; the viewers accept the array without its closing
+    bracket, so a trace of a process that did not shut down cleanly can still be opened.
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path: Path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._file.write("[\n")
+        self._first: bool = True
+        self._pid: int = os.getpid()
+
+    def export(self, span: Span) -> None:
+        event = {
+            "name": span.name,
+            "cat": span.name.split(".", 1)[0],
+            "ph": "X",
+            "ts": span.start * 1e6,
+            "dur": span.duration * 1e6,
+            "pid": self._pid,
+            "tid": span.thread,
+            "args": {**span.attributes, **({"error": span.error} if span.error else {})},
+        }
+        self._file.write(("" if self._first else ",\n") + json.dumps(event, ensure_ascii=False, default=str))
+        self._first = False
+
+    def close(self) -> None:
+        self._file.write("\n]\n")
+        self._file.close()
+
+
+class Tracer:
+    """creates spans and hands finished spans to the exporters, spans cost almost nothing without exporters"""
+    def __init__(self):
+        self.exporters: list[SpanExporter] = []
+        self._ids = itertools.count(1)
+        # asyncio task or thread -> small lane number, concurrent tasks get their own lane in a trace viewer
+        self._lanes: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._thread_lanes: dict[int, int] = {}
+        self._lane_ids = itertools.count(1)
+
+    @property
+    def enabled(self) -> bool:
+        """guard for attributes that are costly to compute"""
+        return bool(self.exporters)
+
+    def add_exporter(self, exporter: SpanExporter) -> None:
+        self.exporters.append(exporter)
+
+    def configure(self, jsonl: str | None = None, chrome: str | None = None) -> None:
+        """add the file exporters named by the "tracing" config section"""
+        if jsonl:
+            self.add_exporter(JsonlExporter(jsonl))
+        if chrome:
+            self.add_exporter(ChromeTraceExporter(chrome))
+
+    def shutdown(self) -> None:
+        exporters, self.exporters = self.exporters, []
+        for exporter in exporters:
+            try:
+                exporter.close()
+            except Exception as e:
+                logging.warning(f"Failed to close span exporter {type(exporter).__name__}: {e}")
+
+    def _thread_id(self) -> int:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is None:
+            return self._thread_lanes.setdefault(threading.get_ident(), next(self._lane_ids))
+        lane = self._lanes.get(task)
+        if lane is None:
+            lane = self._lanes[task] = next(self._lane_ids)
+        return lane
+
+    @staticmethod
+    def current_span() -> Span | None:
+        return _current_span.get()
+
+    def start_span(self, name: str, **attributes: Any) -> Span:
+        """a span that is not made current, end it with span.end(), for async generators and callbacks"""
+        return Span(self, name, _current_span.get(), attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """time the block, spans started inside the block and its child tasks are nested under it"""
+        span = self.start_span(name, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.end(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    def _export(self, span: Span) -> None:
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception as e:
+                logging.warning(f"Span exporter {type(exporter).__name__} failed: {e}")
+
+
+# process wide tracer, configured by the "tracing" section of the server config
+tracer = Tracer()